@@ -3,8 +3,11 @@ import asyncio
 from fastapi import APIRouter
 from loguru import logger
 
+from .coordination import watch_changes
 from .crud import db
-from .tasks import wait_for_paid_invoices
+from .journal import payment_journal
+from .swaps import track_swaps_task
+from .tasks import reconcile_pending_payments_task, wait_for_paid_invoices
 from .views import fossa_generic_router
 from .views_api import fossa_api_router
 from .views_api_atm import fossa_api_atm_router
@@ -26,12 +29,14 @@ fossa_static_files = [
 scheduled_tasks: list[asyncio.Task] = []
 
 
-def fossa_stop():
+async def fossa_stop():
     for task in scheduled_tasks:
         try:
             task.cancel()
         except Exception as ex:
             logger.warning(ex)
+    # write out the events still buffered
+    await payment_journal.flush()
 
 
 def fossa_start():
@@ -41,6 +46,16 @@ def fossa_start():
         "ext_boltz_paid_invoices", wait_for_paid_invoices
     )
     scheduled_tasks.append(paid_invoices)
+    reconcile = create_permanent_unique_task(
+        "ext_fossa_reconcile", reconcile_pending_payments_task
+    )
+    scheduled_tasks.append(reconcile)
+    changes = create_permanent_unique_task("ext_fossa_changes", watch_changes)
+    scheduled_tasks.append(changes)
+    swaps = create_permanent_unique_task("ext_fossa_swaps", track_swaps_task)
+    scheduled_tasks.append(swaps)
+    journal = create_permanent_unique_task("ext_fossa_journal", payment_journal.run)
+    scheduled_tasks.append(journal)
 
 
 __all__ = ["db", "fossa_ext", "fossa_start", "fossa_static_files", "fossa_stop"]
@@ -0,0 +1,229 @@
+"""
+Micro benchmarks for storage and hot paths of the extension, on synthetic data.
+
+    python -m fossa.benchmarks payload --rows 1000000
+
+`payload` compares the fossa_payment table with and without the stored payload
+url: database size and the time of full scans.
+
+`rows` compares mapping and serializing payment listings through pydantic models
+with the slotted `FossaPaymentRow` records.
+
+`pricing` counts exchange rate lookups per withdraw, for the steps of each flow
+(atm page then `/api/v1/ln`, or lnurl scan then callback), before and after the
+pricing engine.
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+from collections.abc import Callable
+
+PAYMENT_COLUMNS = """
+    id TEXT NOT NULL PRIMARY KEY,
+    fossa_id TEXT NOT NULL,
+    payment_hash TEXT,
+    {payload}
+    pin INT,
+    sats INTEGER,
+    amount FLOAT NOT NULL DEFAULT 0,
+    timestamp TIMESTAMP NOT NULL
+"""
+
+
+def _random_text(length: int, alphabet: str = string.ascii_letters) -> str:
+    return "".join(random.choices(alphabet, k=length))
+
+
+def synthetic_payments(rows: int, devices: int) -> list[tuple]:
+    fossa_ids = [_random_text(5) for _ in range(devices)]
+    now = time.time()
+    return [
+        (
+            _random_text(22, string.ascii_letters + string.digits + "-_"),
+            random.choice(fossa_ids),
+            _random_text(64, "0123456789abcdef") if random.random() < 0.9 else None,
+            random.randint(1000, 9999),
+            random.randint(100, 100_000),
+            random.randint(100, 100_000),
+            now - random.random() * 86400 * 365,
+        )
+        for _ in range(rows)
+    ]
+
+
+def _timed(func: Callable[[], object], repeat: int = 3) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _payment_table(
+    path: str, rows: list[tuple], host: str | None
+) -> sqlite3.Connection:
+    conn = sqlite3.connect(path)
+    payload = "payload TEXT NOT NULL," if host else ""
+    conn.execute(
+        f"CREATE TABLE fossa_payment ({PAYMENT_COLUMNS.format(payload=payload)})"
+    )
+    conn.execute("CREATE INDEX idx_fossa_id ON fossa_payment (fossa_id)")
+    if host:
+        conn.executemany(
+            "INSERT INTO fossa_payment "
+            "(id, fossa_id, payment_hash, pin, sats, amount, timestamp, payload) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((*row, f"{host}/fossa/api/v1/lnurl/{row[1]}?p={row[0]}") for row in rows),
+        )
+    else:
+        conn.executemany(
+            "INSERT INTO fossa_payment "
+            "(id, fossa_id, payment_hash, pin, sats, amount, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            rows,
+        )
+    conn.commit()
+    conn.execute("VACUUM")
+    return conn
+
+
+def bench_payload(args: argparse.Namespace) -> None:
+    rows = synthetic_payments(args.rows, args.devices)
+    fossa_id = rows[0][1]
+    host = "https://lnbits.example.com"
+    print(f"{'schema':<16}{'size MB':>10}{'scan ms':>10}{'device ms':>11}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, with_payload in (("with payload", True), ("without", False)):
+            path = os.path.join(tmp, f"{name}.sqlite3")
+            conn = _payment_table(path, rows, host if with_payload else None)
+
+            def full_scan(conn: sqlite3.Connection = conn) -> list:
+                return conn.execute(
+                    "SELECT SUM(sats), SUM(amount) FROM fossa_payment"
+                ).fetchall()
+
+            def device_scan(conn: sqlite3.Connection = conn) -> list:
+                return conn.execute(
+                    "SELECT * FROM fossa_payment WHERE fossa_id = ? "
+                    "ORDER BY timestamp DESC",
+                    (fossa_id,),
+                ).fetchall()
+
+            scan = _timed(full_scan)
+            device = _timed(device_scan)
+            conn.close()
+            size = os.path.getsize(path) / 1024 / 1024
+            print(f"{name:<16}{size:>10.1f}{scan * 1000:>10.1f}{device * 1000:>11.2f}")
+
+    # what the lazy rebuild costs when a listing needs the urls again
+    rebuild = _timed(
+        lambda: [f"{host}/fossa/api/v1/lnurl/{row[1]}?p={row[0]}" for row in rows]
+    )
+    print(f"rebuilding {len(rows)} payload urls: {rebuild * 1000:.1f} ms")
+
+
+def bench_rows(args: argparse.Namespace) -> None:
+    from fastapi.encoders import jsonable_encoder
+    from lnbits.db import dict_to_model
+
+    from .models import FossaPayment, FossaPaymentRow
+
+    keys = ("id", "fossa_id", "payment_hash", "pin", "sats", "amount", "timestamp")
+    rows = [
+        dict(zip(keys, row, strict=True)) for row in synthetic_payments(args.rows, 100)
+    ]
+
+    def model_path() -> str:
+        models = [dict_to_model(row, FossaPayment) for row in rows]
+        return json.dumps(jsonable_encoder(models))
+
+    def row_path() -> str:
+        return json.dumps([FossaPaymentRow(row).dict() for row in rows])
+
+    print(f"{'path':<12}{'ms':>10}{'rows/s':>12}")
+    for name, func in (("model", model_path), ("row", row_path)):
+        elapsed = _timed(func)
+        print(f"{name:<12}{elapsed * 1000:>10.1f}{len(rows) / elapsed:>12.0f}")
+
+
+def bench_pricing(args: argparse.Namespace) -> None:
+    import asyncio
+
+    from lnbits.utils import exchange_rates
+
+    from . import pricing
+    from .models import Fossa, LnurlDecrypted
+
+    calls = 0
+
+    async def _rate(currency: str) -> tuple[float, float]:
+        nonlocal calls
+        calls += 1
+        return 1666.0, 60_000.0
+
+    exchange_rates.get_fiat_rate_and_price_satoshis = _rate
+    fossa = Fossa(
+        id="fossa",
+        key="key",
+        title="bench",
+        wallet="wallet",
+        profit=2,
+        currency="USD",
+        boltz=False,
+    )
+    # quote steps of each flow, the lnurl callback uses the stored amount
+    flows = {"atm page + ln": 2, "lnurl scan + callback": 1}
+
+    async def legacy_step(decrypted: LnurlDecrypted) -> None:
+        # price_sat and amount_to_sats each fetched the rate
+        await exchange_rates.fiat_amount_as_satoshis(decrypted.amount / 100, "USD")
+        await exchange_rates.fiat_amount_as_satoshis(decrypted.amount / 100, "USD")
+
+    async def engine_step(decrypted: LnurlDecrypted, payload: str) -> None:
+        await pricing.quote_withdraw(fossa, decrypted, payload)
+
+    async def run() -> None:
+        nonlocal calls
+        print(f"{'flow':<24}{'path':<8}{'rate calls/withdraw':>20}")
+        for flow, steps in flows.items():
+            for name in ("legacy", "engine"):
+                calls = 0
+                for i in range(args.rows):
+                    decrypted = LnurlDecrypted(pin=1, amount=random.randint(1, 500))
+                    for _ in range(steps):
+                        if name == "legacy":
+                            await legacy_step(decrypted)
+                        else:
+                            await engine_step(decrypted, f"{flow}{i}")
+                print(f"{flow:<24}{name:<8}{calls / args.rows:>20.1f}")
+
+    asyncio.run(run())
+
+
+BENCHMARKS = {"payload": bench_payload, "pricing": bench_pricing, "rows": bench_rows}
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fossa micro benchmarks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    args = parse_args(argv)
+    random.seed(args.seed)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
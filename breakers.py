@@ -0,0 +1,165 @@
+import asyncio
+from collections.abc import Awaitable, Callable
+from math import ceil
+from time import time
+from typing import TypeVar
+
+import httpx
+from loguru import logger
+
+from .models import CircuitState, CircuitStatus
+
+# timeout budgets per upstream, an atm customer is waiting on each of them
+BOLTZ_TIMEOUT_SECONDS = 30
+BOLTZ_STATUS_TIMEOUT_SECONDS = 10
+LNURL_TIMEOUT_SECONDS = 10
+RATES_TIMEOUT_SECONDS = 5
+
+# consecutive failures that open a breaker, and how long it stays open before
+# a single request may probe the upstream again
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_SECONDS = 30
+# lnurl breakers are per host, forget healthy ones above this
+CIRCUIT_MAX_BREAKERS = 1000
+
+T = TypeVar("T")
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream that is failing."""
+
+    def __init__(self, breaker: "CircuitBreaker"):
+        self.breaker = breaker
+        super().__init__(
+            f"{breaker.name} is unavailable, retry in {breaker.retry_in()} seconds."
+        )
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        timeout: float,
+        failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD,
+        reset_seconds: int = CIRCUIT_RESET_SECONDS,
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    def retry_in(self) -> int:
+        if self.state == CircuitState.CLOSED or self.opened_at is None:
+            return 0
+        return max(ceil(self.opened_at + self.reset_seconds - time()), 0)
+
+    def available(self) -> bool:
+        """False while calls would fail fast, checks nothing else."""
+        if self.state == CircuitState.CLOSED:
+            return True
+        return not self._probing and self.retry_in() == 0
+
+    async def call(
+        self,
+        func: Callable[[], Awaitable[T]],
+        is_failure: Callable[[Exception], bool] | None = None,
+    ) -> T:
+        """
+        Run `func` within the timeout budget. Raises `CircuitOpenError` without
+        calling it while the breaker is open, after `reset_seconds` one call is
+        let through to probe the upstream. With `is_failure` only the errors it
+        accepts count, others mean the upstream did answer.
+        """
+        if not self.available():
+            raise CircuitOpenError(self)
+        if self.state != CircuitState.CLOSED:
+            self.state = CircuitState.HALF_OPEN
+            self._probing = True
+        try:
+            result = await asyncio.wait_for(func(), self.timeout)
+        except Exception as ex:
+            if is_failure is None or is_failure(ex):
+                self._failure(ex)
+            else:
+                self._success()
+            raise
+        finally:
+            self._probing = False
+        self._success()
+        return result
+
+    def _failure(self, ex: Exception) -> None:
+        self.failures += 1
+        if (
+            self.state == CircuitState.HALF_OPEN
+            or self.failures >= self.failure_threshold
+        ):
+            if self.state != CircuitState.OPEN:
+                logger.warning(f"Fossa circuit {self.name} opened: {ex!r}")
+            self.state = CircuitState.OPEN
+            self.opened_at = time()
+
+    def _success(self) -> None:
+        if self.state != CircuitState.CLOSED:
+            logger.info(f"Fossa circuit {self.name} closed again.")
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def status(self) -> CircuitStatus:
+        return CircuitStatus(
+            name=self.name,
+            state=self.state,
+            failures=self.failures,
+            opened_at=self.opened_at,
+            retry_in=self.retry_in(),
+        )
+
+
+boltz_breaker = CircuitBreaker("Boltz", BOLTZ_TIMEOUT_SECONDS)
+boltz_status_breaker = CircuitBreaker("Boltz status", BOLTZ_STATUS_TIMEOUT_SECONDS)
+rates_breaker = CircuitBreaker("Exchange rate service", RATES_TIMEOUT_SECONDS)
+
+_lnurl_breakers: dict[str, CircuitBreaker] = {}
+
+
+def upstream_failure(ex: BaseException) -> bool:
+    """
+    Timeouts, transport errors and 5xx responses, also when wrapped like by the
+    lnurl library, which re-raises with and without `from`. An unknown address
+    or an amount out of range is an answer.
+    """
+    cause: BaseException | None = ex
+    while cause is not None:
+        if isinstance(cause, (asyncio.TimeoutError, httpx.TransportError)):
+            return True
+        if (
+            isinstance(cause, httpx.HTTPStatusError)
+            and cause.response.status_code >= 500
+        ):
+            return True
+        cause = cause.__cause__ or cause.__context__
+    return False
+
+
+def lnurl_breaker(host: str) -> CircuitBreaker:
+    """Breaker per lnurl host, one failing wallet provider does not block others."""
+    breaker = _lnurl_breakers.get(host)
+    if not breaker:
+        if len(_lnurl_breakers) >= CIRCUIT_MAX_BREAKERS:
+            for key in [k for k, b in _lnurl_breakers.items() if b.failures == 0]:
+                del _lnurl_breakers[key]
+        breaker = CircuitBreaker(
+            f"Lightning address server {host}", LNURL_TIMEOUT_SECONDS
+        )
+        _lnurl_breakers[host] = breaker
+    return breaker
+
+
+def breaker_statuses() -> list[CircuitStatus]:
+    breakers = [boltz_breaker, boltz_status_breaker, rates_breaker]
+    return [breaker.status() for breaker in breakers + list(_lnurl_breakers.values())]
@@ -0,0 +1,59 @@
+import asyncio
+from collections.abc import Callable
+
+from lnbits.helpers import urlsafe_short_hash
+from loguru import logger
+
+from .crud import acquire_lease, bump_change_version, get_change_versions
+
+# identifies this process when several lnbits workers share the database
+worker_id = urlsafe_short_hash()
+
+CHANGE_POLL_INTERVAL_SECONDS = 5
+
+_change_listeners: dict[str, list[Callable[[], None]]] = {}
+_change_versions: dict[str, int] = {}
+
+
+async def is_leader(job: str, ttl: int) -> bool:
+    """
+    Leader election for periodic jobs, only the worker holding the lease runs the
+    job. Call at least every `ttl` seconds to keep it.
+    """
+    try:
+        return await acquire_lease(f"leader_{job}", worker_id, ttl)
+    except Exception as ex:
+        logger.warning(f"Fossa leader election for {job} failed: {ex}")
+        return False
+
+
+def on_change(name: str, callback: Callable[[], None]) -> None:
+    """Register a callback, e.g. a cache clear, for changes on any worker."""
+    _change_listeners.setdefault(name, []).append(callback)
+
+
+def _notify_listeners(name: str) -> None:
+    for callback in _change_listeners.get(name, []):
+        try:
+            callback()
+        except Exception as ex:
+            logger.warning(f"Fossa change listener for {name} failed: {ex}")
+
+
+async def notify_change(name: str) -> None:
+    """Signal a change to this and all other workers."""
+    await bump_change_version(name)
+    _notify_listeners(name)
+
+
+async def watch_changes():
+    while True:
+        try:
+            versions = await get_change_versions()
+            for name, version in versions.items():
+                if name in _change_versions and _change_versions[name] != version:
+                    _notify_listeners(name)
+                _change_versions[name] = version
+        except Exception as ex:
+            logger.warning(f"Fossa change watcher failed: {ex}")
+        await asyncio.sleep(CHANGE_POLL_INTERVAL_SECONDS)
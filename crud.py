@@ -1,12 +1,34 @@
+from datetime import datetime
+from time import time
+
 import shortuuid
-from lnbits.db import Database
+from lnbits.core.db import db as core_db
+from lnbits.core.models import Payment
+from lnbits.db import Database, insert_query, model_to_dict
 from lnbits.helpers import urlsafe_short_hash
 
-from .models import CreateFossa, Fossa, FossaPayment
+from .models import (
+    CreateFossa,
+    Fossa,
+    FossaFiatReport,
+    FossaPayment,
+    FossaPaymentRow,
+    FossaRow,
+    FossaSwap,
+    FossaWithdrawOutcome,
+    PaymentEvent,
+    Tombstone,
+)
+from .tracing import traced
 
 db = Database("ext_fossa")
 
 
+def now_ms() -> int:
+    """Unix time in milliseconds, used for `updated_at` and sync cursors."""
+    return int(time() * 1000)
+
+
 async def create_fossa(data: CreateFossa) -> Fossa:
     fossa_id = shortuuid.uuid()[:5]
     fossa_key = urlsafe_short_hash()[:16]
@@ -18,16 +40,23 @@ async def create_fossa(data: CreateFossa) -> Fossa:
         profit=data.profit,
         currency=data.currency,
         boltz=data.boltz,
+        hourly_limit=data.hourly_limit,
+        daily_limit=data.daily_limit,
+        wallet_hourly_limit=data.wallet_hourly_limit,
+        wallet_daily_limit=data.wallet_daily_limit,
+        updated_at=now_ms(),
     )
     await db.insert("fossa.fossa", fossa)
     return fossa
 
 
 async def update_fossa(fossa: Fossa) -> Fossa:
+    fossa.updated_at = now_ms()
     await db.update("fossa.fossa", fossa)
     return fossa
 
 
+@traced()
 async def get_fossa(fossa_id: str) -> Fossa | None:
     return await db.fetchone(
         "SELECT * FROM fossa.fossa WHERE id = :id",
@@ -36,30 +65,77 @@ async def get_fossa(fossa_id: str) -> Fossa | None:
     )
 
 
-async def get_fossas(wallet_ids: list[str]) -> list[Fossa]:
+async def get_fossas(wallet_ids: list[str]) -> list[FossaRow]:
     q = ",".join([f"'{w}'" for w in wallet_ids])
-    return await db.fetchall(
+    rows: list[dict] = await db.fetchall(
         f"""
         SELECT * FROM fossa.fossa WHERE wallet IN ({q}) ORDER BY id
-        """,
-        model=Fossa,
+        """
     )
+    return [FossaRow(row) for row in rows]
 
 
 async def delete_fossa(fossa_id: str) -> None:
-    await db.execute("DELETE FROM fossa.fossa WHERE id = :id", {"id": fossa_id})
+    # its payments leave the delta with the device, so they get tombstones too.
+    # lnbits commits every statement, the tombstones go first and are taken
+    # back if the delete fails
+    values = {"id": fossa_id, "now": now_ms()}
+    await db.execute(
+        """
+        INSERT INTO fossa.tombstone (kind, id, wallet, deleted_at)
+        SELECT 'fossa', id, wallet, :now FROM fossa.fossa WHERE id = :id
+        ON CONFLICT (kind, id) DO UPDATE SET deleted_at = :now
+        """,
+        values,
+    )
+    await db.execute(
+        """
+        INSERT INTO fossa.tombstone (kind, id, wallet, deleted_at)
+        SELECT 'fossa_payment', p.id, f.wallet, :now
+        FROM fossa.fossa_payment p JOIN fossa.fossa f ON f.id = p.fossa_id
+        WHERE p.fossa_id = :id
+        ON CONFLICT (kind, id) DO UPDATE SET deleted_at = :now
+        """,
+        values,
+    )
+    try:
+        await db.execute("DELETE FROM fossa.fossa WHERE id = :id", values)
+    except Exception:
+        await db.execute(
+            """
+            DELETE FROM fossa.tombstone WHERE deleted_at = :now AND (
+                (kind = 'fossa' AND id = :id) OR (kind = 'fossa_payment'
+                AND id IN (SELECT id FROM fossa.fossa_payment WHERE fossa_id = :id))
+            )
+            """,
+            values,
+        )
+        raise
 
 
-async def create_fossa_payment(fossa_payment: FossaPayment) -> FossaPayment:
-    await db.insert("fossa.fossa_payment", fossa_payment)
-    return fossa_payment
+@traced()
+async def create_fossa_payment_if_new(fossa_payment: FossaPayment) -> bool:
+    """
+    Insert a payment unless a concurrent request created it first, returns False
+    in that case.
+    """
+    fossa_payment.updated_at = now_ms()
+    result = await db.execute(
+        f"{insert_query('fossa.fossa_payment', fossa_payment)} "
+        "ON CONFLICT (id) DO NOTHING",
+        model_to_dict(fossa_payment),
+    )
+    return result.rowcount == 1
 
 
+@traced()
 async def update_fossa_payment(fossa_payment: FossaPayment) -> FossaPayment:
+    fossa_payment.updated_at = now_ms()
     await db.update("fossa.fossa_payment", fossa_payment)
     return fossa_payment
 
 
+@traced()
 async def get_fossa_payment(
     fossa_payment_id: str,
 ) -> FossaPayment:
@@ -70,30 +146,461 @@ async def get_fossa_payment(
     )
 
 
-async def get_fossa_payment_by_hash(
-    payment_hash: str,
-) -> FossaPayment:
-    return await db.fetchone(
-        "SELECT * FROM fossa.fossa_payment WHERE payment_hash = :payment_hash",
-        {"payment_hash": payment_hash},
-        FossaPayment,
-    )
-
-
 async def get_fossa_payments(
     fossa_ids: list[str],
-) -> list[FossaPayment]:
+) -> list[FossaPaymentRow]:
     if len(fossa_ids) == 0:
         return []
     q = ",".join([f"'{w}'" for w in fossa_ids])
-    return await db.fetchall(
+    rows: list[dict] = await db.fetchall(
         f"""
         SELECT * FROM fossa.fossa_payment WHERE fossa_id IN ({q})
         ORDER BY id
-        """,
-        model=FossaPayment,
+        """
     )
+    return [FossaPaymentRow(row) for row in rows]
 
 
 async def delete_atm_payment_link(atm_id: str) -> None:
-    await db.execute("DELETE FROM fossa.fossa_payment WHERE id = :id", {"id": atm_id})
+    # lnbits commits every statement, the tombstone goes first and is taken back
+    # if the delete fails
+    values = {"id": atm_id, "now": now_ms()}
+    await db.execute(
+        """
+        INSERT INTO fossa.tombstone (kind, id, wallet, deleted_at)
+        SELECT 'fossa_payment', p.id, f.wallet, :now
+        FROM fossa.fossa_payment p JOIN fossa.fossa f ON f.id = p.fossa_id
+        WHERE p.id = :id
+        ON CONFLICT (kind, id) DO UPDATE SET deleted_at = :now
+        """,
+        values,
+    )
+    try:
+        await db.execute("DELETE FROM fossa.fossa_payment WHERE id = :id", values)
+    except Exception:
+        await db.execute(
+            """
+            DELETE FROM fossa.tombstone
+            WHERE kind = 'fossa_payment' AND id = :id AND deleted_at = :now
+            """,
+            values,
+        )
+        raise
+    await delete_withdraw_outcome(atm_id)
+
+
+async def get_pending_fossa_payments(
+    older_than: int, fossa_ids: list[str] | None = None
+) -> list[FossaPayment]:
+    """Payments claimed as `pending` before `older_than` (unix ms)."""
+    # the claim sets `updated_at`, `timestamp` is the scan of the voucher.
+    # payments with a started swap are held as `pending_swap_` instead
+    where = ["payment_hash = 'pending'", "updated_at < :older_than"]
+    if fossa_ids is not None:
+        if len(fossa_ids) == 0:
+            return []
+        q = ",".join([f"'{w}'" for w in fossa_ids])
+        where.append(f"fossa_id IN ({q})")
+    return await db.fetchall(
+        f"""
+        SELECT * FROM fossa.fossa_payment WHERE {" AND ".join(where)}
+        ORDER BY updated_at
+        """,
+        {"older_than": older_than},
+        FossaPayment,
+    )
+
+
+async def release_fossa_payments(fossa_payment_ids: list[str]) -> None:
+    if len(fossa_payment_ids) == 0:
+        return
+    q = ",".join([f"'{w}'" for w in fossa_payment_ids])
+    await db.execute(
+        f"""
+        UPDATE fossa.fossa_payment SET payment_hash = NULL, updated_at = :now
+        WHERE payment_hash = 'pending' AND id IN ({q})
+        """,
+        {"now": now_ms()},
+    )
+
+
+async def settle_fossa_payments(payment_hashes: dict[str, str]) -> None:
+    """`payment_hashes` maps a fossa_payment id to its core payment hash."""
+    if len(payment_hashes) == 0:
+        return
+    cases = []
+    ids = []
+    values: dict = {"now": now_ms()}
+    for i, (fossa_payment_id, payment_hash) in enumerate(payment_hashes.items()):
+        cases.append(f"WHEN :i{i} THEN :h{i}")
+        ids.append(f":i{i}")
+        values.update({f"i{i}": fossa_payment_id, f"h{i}": payment_hash})
+    # one statement for the whole batch
+    await db.execute(
+        f"""
+        UPDATE fossa.fossa_payment
+        SET payment_hash = CASE id {" ".join(cases)} END, updated_at = :now
+        WHERE payment_hash = 'pending' AND id IN ({", ".join(ids)})
+        """,
+        values,
+    )
+
+
+async def get_core_fossa_payments(since: datetime) -> list[Payment]:
+    """
+    Outgoing core payments made by fossa, tagged with `extra.id`. The lnurl
+    callback did not tag its payments with the id before the upgrade.
+    """
+    return await core_db.fetchall(
+        f"""
+        SELECT * FROM apipayments
+        WHERE tag = 'fossa' AND amount < 0
+        AND time >= {core_db.timestamp_placeholder('since')}
+        """,
+        {"since": since},
+        Payment,
+    )
+
+
+async def get_recorded_payment_hashes(payment_hashes: list[str]) -> set[str]:
+    """Which of `payment_hashes` already settled a fossa payment."""
+    if len(payment_hashes) == 0:
+        return set()
+    q = ",".join([f"'{h}'" for h in payment_hashes])
+    rows: list[dict] = await db.fetchall(
+        f"SELECT payment_hash FROM fossa.fossa_payment WHERE payment_hash IN ({q})"
+    )
+    return {row["payment_hash"] for row in rows}
+
+
+async def claim_fossa_payment(fossa_payment_id: str, claim: str = "pending") -> bool:
+    """
+    Atomically mark an unclaimed payment, returns False if it was already claimed
+    by another request or worker. This row level claim is what keeps workers
+    from paying a voucher twice, leases are only used for leader election.
+    """
+    result = await db.execute(
+        """
+        UPDATE fossa.fossa_payment SET payment_hash = :claim, updated_at = :now
+        WHERE id = :id AND payment_hash IS NULL
+        """,
+        {"id": fossa_payment_id, "claim": claim, "now": now_ms()},
+    )
+    return result.rowcount == 1
+
+
+async def acquire_lease(lease_id: str, owner: str, ttl: int) -> bool:
+    """Take or renew a lease, succeeds if it is free, expired or already ours."""
+    now = int(time())
+    await db.execute(
+        """
+        INSERT INTO fossa.lease (id, owner, expires_at)
+        VALUES (:id, :owner, :expires_at)
+        ON CONFLICT (id) DO UPDATE
+        SET owner = :owner, expires_at = :expires_at
+        WHERE lease.expires_at < :now OR lease.owner = :owner
+        """,
+        {"id": lease_id, "owner": owner, "expires_at": now + ttl, "now": now},
+    )
+    row: dict | None = await db.fetchone(
+        "SELECT owner FROM fossa.lease WHERE id = :id", {"id": lease_id}
+    )
+    return bool(row and row["owner"] == owner)
+
+
+async def release_lease(lease_id: str, owner: str) -> None:
+    await db.execute(
+        "DELETE FROM fossa.lease WHERE id = :id AND owner = :owner",
+        {"id": lease_id, "owner": owner},
+    )
+
+
+async def bump_change_version(name: str) -> None:
+    await db.execute(
+        "UPDATE fossa.change_version SET version = version + 1 WHERE name = :name",
+        {"name": name},
+    )
+
+
+async def get_change_versions() -> dict[str, int]:
+    rows: list[dict] = await db.fetchall("SELECT * FROM fossa.change_version")
+    return {row["name"]: row["version"] for row in rows}
+
+
+async def create_fossa_swap(swap: FossaSwap) -> FossaSwap:
+    await db.insert("fossa.swap", swap)
+    return swap
+
+
+async def set_fossa_swap(swap: FossaSwap) -> FossaSwap:
+    """Insert the swap or start over an earlier one with the same id."""
+    await db.execute(
+        f"""
+        {insert_query("fossa.swap", swap)}
+        ON CONFLICT (id) DO UPDATE SET status = :status, attempts = :attempts,
+        next_check = :next_check, onchain_address = :onchain_address,
+        timestamp = :timestamp
+        """,
+        model_to_dict(swap),
+    )
+    return swap
+
+
+async def get_fossa_swap(swap_id: str) -> FossaSwap | None:
+    return await db.fetchone(
+        "SELECT * FROM fossa.swap WHERE id = :id", {"id": swap_id}, FossaSwap
+    )
+
+
+async def update_fossa_swap(swap: FossaSwap) -> FossaSwap:
+    await db.update("fossa.swap", swap)
+    return swap
+
+
+async def get_due_fossa_swaps(now: int, limit: int) -> list[FossaSwap]:
+    return await db.fetchall(
+        """
+        SELECT * FROM fossa.swap
+        WHERE next_check IS NOT NULL AND next_check <= :now
+        ORDER BY next_check LIMIT :limit
+        """,
+        {"now": now, "limit": limit},
+        FossaSwap,
+    )
+
+
+async def schedule_fossa_swap_check(swap_id: str, at: int) -> bool:
+    result = await db.execute(
+        """
+        UPDATE fossa.swap SET next_check = :at
+        WHERE id = :id AND next_check IS NOT NULL
+        """,
+        {"id": swap_id, "at": at},
+    )
+    return result.rowcount == 1
+
+
+async def get_claimed_fossa_payment_amounts(since: int) -> list[dict]:
+    """
+    Withdrawn amounts claimed since `since` (unix ms), with the fossa wallet and
+    unix time. The claim sets `updated_at`, `timestamp` is the scan.
+    """
+    rows: list[dict] = await db.fetchall(
+        """
+        SELECT p.fossa_id, f.wallet, p.amount, p.updated_at
+        FROM fossa.fossa_payment p JOIN fossa.fossa f ON f.id = p.fossa_id
+        WHERE p.payment_hash IS NOT NULL AND p.updated_at >= :since
+        """,
+        {"since": since},
+    )
+    return [
+        {
+            "fossa_id": row["fossa_id"],
+            "wallet": row["wallet"],
+            "amount": int(row["amount"]),
+            "at": row["updated_at"] / 1000,
+        }
+        for row in rows
+    ]
+
+
+async def get_claimed_fossa_payment_totals(
+    fossa_id: str, wallet: str, hour_since: int, day_since: int
+) -> dict[str, int]:
+    """Claimed sats of a fossa and its wallet in the last hour and day."""
+    row: dict | None = await db.fetchone(
+        """
+        SELECT
+        SUM(CASE WHEN p.fossa_id = :fossa_id AND p.updated_at >= :hour_since
+            THEN p.amount ELSE 0 END) AS fossa_hourly,
+        SUM(CASE WHEN p.fossa_id = :fossa_id THEN p.amount ELSE 0 END)
+            AS fossa_daily,
+        SUM(CASE WHEN p.updated_at >= :hour_since THEN p.amount ELSE 0 END)
+            AS wallet_hourly,
+        SUM(p.amount) AS wallet_daily
+        FROM fossa.fossa_payment p JOIN fossa.fossa f ON f.id = p.fossa_id
+        WHERE f.wallet = :wallet AND p.payment_hash IS NOT NULL
+        AND p.updated_at >= :day_since
+        """,
+        {
+            "fossa_id": fossa_id,
+            "wallet": wallet,
+            "hour_since": hour_since,
+            "day_since": day_since,
+        },
+    )
+    keys = ("fossa_hourly", "fossa_daily", "wallet_hourly", "wallet_daily")
+    return {key: int(row[key] or 0) if row else 0 for key in keys}
+
+
+async def set_withdraw_outcome(outcome: FossaWithdrawOutcome) -> None:
+    """Store the outcome of a withdraw, replacing its in flight marker."""
+    await db.execute(
+        f"""
+        {insert_query("fossa.withdraw_outcome", outcome)}
+        ON CONFLICT (id) DO UPDATE SET destination = :destination,
+        payment_hash = :payment_hash, response = :response, timestamp = :timestamp
+        """,
+        model_to_dict(outcome),
+    )
+
+
+@traced()
+async def get_withdraw_outcome(fossa_payment_id: str) -> FossaWithdrawOutcome | None:
+    return await db.fetchone(
+        "SELECT * FROM fossa.withdraw_outcome WHERE id = :id",
+        {"id": fossa_payment_id},
+        FossaWithdrawOutcome,
+    )
+
+
+async def delete_withdraw_outcome(fossa_payment_id: str) -> None:
+    await db.execute(
+        "DELETE FROM fossa.withdraw_outcome WHERE id = :id", {"id": fossa_payment_id}
+    )
+
+
+async def get_fossas_changed(wallet_ids: list[str], since: int) -> list[Fossa]:
+    if len(wallet_ids) == 0:
+        return []
+    q = ",".join([f"'{w}'" for w in wallet_ids])
+    return await db.fetchall(
+        f"""
+        SELECT * FROM fossa.fossa
+        WHERE updated_at > :since AND wallet IN ({q})
+        ORDER BY updated_at
+        """,
+        {"since": since},
+        Fossa,
+    )
+
+
+async def get_fossa_payments_changed(
+    wallet_ids: list[str], since: int
+) -> list[FossaPayment]:
+    if len(wallet_ids) == 0:
+        return []
+    q = ",".join([f"'{w}'" for w in wallet_ids])
+    return await db.fetchall(
+        f"""
+        SELECT p.* FROM fossa.fossa_payment p JOIN fossa.fossa f ON f.id = p.fossa_id
+        WHERE p.updated_at > :since AND f.wallet IN ({q})
+        ORDER BY p.updated_at
+        """,
+        {"since": since},
+        FossaPayment,
+    )
+
+
+async def get_tombstones(wallet_ids: list[str], since: int) -> list[Tombstone]:
+    if len(wallet_ids) == 0:
+        return []
+    q = ",".join([f"'{w}'" for w in wallet_ids])
+    return await db.fetchall(
+        f"""
+        SELECT * FROM fossa.tombstone
+        WHERE deleted_at > :since AND wallet IN ({q})
+        ORDER BY deleted_at
+        """,
+        {"since": since},
+        Tombstone,
+    )
+
+
+async def delete_tombstones(older_than: int) -> None:
+    await db.execute(
+        "DELETE FROM fossa.tombstone WHERE deleted_at < :older_than",
+        {"older_than": older_than},
+    )
+
+
+async def create_payment_events(events: list[PaymentEvent]) -> None:
+    """Append a batch of journal events with one statement."""
+    if len(events) == 0:
+        return
+    rows = []
+    values: dict = {}
+    for i, event in enumerate(events):
+        rows.append(f"(:p{i}, :f{i}, :e{i}, :d{i}, :c{i})")
+        values.update(
+            {
+                f"p{i}": event.fossa_payment_id,
+                f"f{i}": event.fossa_id,
+                f"e{i}": event.event.value,
+                f"d{i}": event.detail,
+                f"c{i}": event.created_at,
+            }
+        )
+    await db.execute(
+        f"""
+        INSERT INTO fossa.payment_event
+        (fossa_payment_id, fossa_id, event, detail, created_at)
+        VALUES {", ".join(rows)}
+        """,
+        values,
+    )
+
+
+async def get_payment_events(fossa_payment_id: str) -> list[PaymentEvent]:
+    return await db.fetchall(
+        """
+        SELECT * FROM fossa.payment_event
+        WHERE fossa_payment_id = :id ORDER BY id
+        """,
+        {"id": fossa_payment_id},
+        PaymentEvent,
+    )
+
+
+async def get_or_create_rate_snapshot(
+    currency: str, minute: int, price_cents: int
+) -> int:
+    """Id of the snapshot of `currency` in `minute`, the first price wins."""
+    values = {"currency": currency, "minute": minute, "price_cents": price_cents}
+    await db.execute(
+        """
+        INSERT INTO fossa.rate_snapshot (currency, minute, price_cents)
+        VALUES (:currency, :minute, :price_cents)
+        ON CONFLICT (currency, minute) DO NOTHING
+        """,
+        values,
+    )
+    row: dict = await db.fetchone(
+        """
+        SELECT id FROM fossa.rate_snapshot
+        WHERE currency = :currency AND minute = :minute
+        """,
+        values,
+    )
+    return row["id"]
+
+
+async def get_fiat_report(
+    wallet_ids: list[str], since: datetime | None = None
+) -> list[FossaFiatReport]:
+    """Paid withdraws per fossa and currency, valued at their rate snapshots."""
+    if len(wallet_ids) == 0:
+        return []
+    q = ",".join([f"'{w}'" for w in wallet_ids])
+    since_clause = (
+        f"AND p.timestamp >= {db.timestamp_placeholder('since')}" if since else ""
+    )
+    # per row division keeps the sums of large histories from overflowing
+    return await db.fetchall(
+        f"""
+        SELECT p.fossa_id, r.currency, COUNT(*) AS payments,
+        SUM(p.sats) AS sats, SUM(p.sats - p.amount) AS fee_sats,
+        SUM(p.sats * r.price_cents / 10000000000.0) AS fiat_amount,
+        SUM((p.sats - p.amount) * r.price_cents / 10000000000.0) AS fiat_fee
+        FROM fossa.fossa_payment p
+        JOIN fossa.fossa f ON f.id = p.fossa_id
+        JOIN fossa.rate_snapshot r ON r.id = p.rate_snapshot_id
+        WHERE f.wallet IN ({q})
+        AND p.payment_hash IS NOT NULL AND p.payment_hash NOT LIKE 'pending%'
+        {since_clause}
+        GROUP BY p.fossa_id, r.currency
+        ORDER BY p.fossa_id, r.currency
+        """,
+        {"since": since},
+        FossaFiatReport,
+    )
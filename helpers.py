@@ -1,11 +1,17 @@
+from typing import TypeVar
 from urllib.parse import parse_qs, urlparse
 
+from fastapi import Request
 from lnbits.utils.crypto import AESCipher
 from lnurl import url_decode
 
-from .models import LnurlDecrypted, LnurlPayload
+from .models import FossaPayment, FossaPaymentRow, LnurlDecrypted, LnurlPayload
+from .tracing import traced
 
+FossaPaymentType = TypeVar("FossaPaymentType", FossaPayment, FossaPaymentRow)
 
+
+@traced()
 def aes_decrypt_payload(payload: str, key: str) -> LnurlDecrypted:
     try:
         aes = AESCipher(key)
@@ -16,6 +22,7 @@ def aes_decrypt_payload(payload: str, key: str) -> LnurlDecrypted:
     return LnurlDecrypted(pin=int(pin), amount=float(amount))
 
 
+@traced()
 def parse_lnurl_payload(lnurl: str) -> LnurlPayload:
     try:
         url = str(url_decode(lnurl))
@@ -34,3 +41,29 @@ def parse_lnurl_payload(lnurl: str) -> LnurlPayload:
         fossa_id=fossa_id,
         payload=p,
     )
+
+
+def lnurl_payload_url(request: Request, fossa_id: str, payload: str) -> str:
+    """The url behind the lnurl of a voucher, as printed by the fossa."""
+    url = request.url_for("fossa.lnurl_params", fossa_id=fossa_id)
+    return f"{url}?p={payload}"
+
+
+def with_payload_urls(
+    request: Request, fossa_payments: list[FossaPaymentType]
+) -> list[FossaPaymentType]:
+    for fossa_payment in fossa_payments:
+        fossa_payment.payload = lnurl_payload_url(
+            request, fossa_payment.fossa_id, fossa_payment.id
+        )
+    return fossa_payments
+
+
+def lnurl_host(lnurl_or_address: str) -> str:
+    """Host serving a bech32 lnurl or lightning address, for per host breakers."""
+    if "@" in lnurl_or_address:
+        return lnurl_or_address.split("@", 1)[1]
+    try:
+        return urlparse(str(url_decode(lnurl_or_address))).hostname or "unknown"
+    except Exception:
+        return "unknown"
@@ -0,0 +1,82 @@
+import asyncio
+
+from loguru import logger
+
+from .crud import create_payment_events, now_ms
+from .models import PaymentEvent, PaymentEventType
+
+JOURNAL_FLUSH_INTERVAL_SECONDS = 2
+# flush early once this many events are waiting, also the insert batch size
+JOURNAL_BATCH_SIZE = 200
+# keep at most this many events while the database is unavailable
+JOURNAL_MAX_BUFFER = 50_000
+
+
+class PaymentJournal:
+    """
+    Buffers payment events in memory and appends them to the journal table in
+    batches, so recording an event never waits on the database.
+    """
+
+    def __init__(self):
+        self.buffer: list[PaymentEvent] = []
+        self.dropped = 0
+        self._full = asyncio.Event()
+        self._lock = asyncio.Lock()
+
+    def record(
+        self,
+        fossa_payment_id: str,
+        fossa_id: str,
+        event: PaymentEventType,
+        detail: str | None = None,
+    ) -> None:
+        self.buffer.append(
+            PaymentEvent(
+                fossa_payment_id=fossa_payment_id,
+                fossa_id=fossa_id,
+                event=event,
+                detail=detail[:500] if detail else None,
+                created_at=now_ms(),
+            )
+        )
+        if len(self.buffer) > JOURNAL_MAX_BUFFER:
+            del self.buffer[0]
+            self.dropped += 1
+        if len(self.buffer) >= JOURNAL_BATCH_SIZE:
+            self._full.set()
+
+    async def flush(self) -> int:
+        """Write all buffered events, returns the number written."""
+        async with self._lock:
+            written = 0
+            while self.buffer:
+                batch = self.buffer[:JOURNAL_BATCH_SIZE]
+                try:
+                    await create_payment_events(batch)
+                except Exception as ex:
+                    logger.warning(f"Fossa journal flush failed: {ex}")
+                    break
+                del self.buffer[: len(batch)]
+                written += len(batch)
+            if self.dropped:
+                logger.warning(f"Fossa journal dropped {self.dropped} events.")
+                self.dropped = 0
+            return written
+
+    async def run(self):
+        while True:
+            if len(self.buffer) < JOURNAL_BATCH_SIZE:
+                try:
+                    await asyncio.wait_for(
+                        self._full.wait(), JOURNAL_FLUSH_INTERVAL_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            if await self.flush() == 0 and self.buffer:
+                # database unavailable, retry on the next interval
+                await asyncio.sleep(JOURNAL_FLUSH_INTERVAL_SECONDS)
+
+
+payment_journal = PaymentJournal()
@@ -0,0 +1,174 @@
+import asyncio
+from collections import deque
+from time import time
+
+from loguru import logger
+
+from .crud import (
+    get_claimed_fossa_payment_amounts,
+    get_claimed_fossa_payment_totals,
+    now_ms,
+    release_fossa_payments,
+)
+from .models import Fossa
+
+HOUR = 3600
+DAY = 86400
+
+
+class RollingWindow:
+    """
+    Sum over a sliding time window kept in time buckets, adding and reading the
+    total are amortised O(1). Amounts leave the window up to one bucket late.
+    """
+
+    __slots__ = ("bucket_seconds", "buckets", "total", "window_seconds")
+
+    def __init__(self, window_seconds: int, bucket_seconds: int):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        self.buckets: deque[list[int]] = deque()
+        self.total = 0
+
+    def _expire(self, now: float) -> None:
+        oldest = int(now - self.window_seconds) // self.bucket_seconds
+        while self.buckets and self.buckets[0][0] < oldest:
+            self.total -= self.buckets.popleft()[1]
+
+    def add(self, amount: int, at: float) -> None:
+        bucket = int(at) // self.bucket_seconds
+        if self.buckets and self.buckets[-1][0] == bucket:
+            self.buckets[-1][1] += amount
+        elif not self.buckets or self.buckets[-1][0] < bucket:
+            self.buckets.append([bucket, amount])
+        else:
+            # out of order, e.g. a release of an older withdraw
+            for item in reversed(self.buckets):
+                if item[0] <= bucket:
+                    item[1] += amount
+                    break
+            else:
+                return
+        self.total += amount
+
+    def sum(self, now: float) -> int:
+        self._expire(now)
+        return self.total
+
+
+class WithdrawLimits:
+    """
+    Hourly and daily withdrawn sats per fossa and per wallet, rebuilt from the
+    database on first use. The counters are per process and reject early, with
+    several workers `verify_claim` checks the totals of all of them in the
+    database after each claim.
+    """
+
+    def __init__(self):
+        self.windows: dict[tuple[str, str], tuple[RollingWindow, RollingWindow]] = {}
+        self.fossa_wallets: dict[str, str] = {}
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+    def _windows(self, kind: str, key: str) -> tuple[RollingWindow, RollingWindow]:
+        windows = self.windows.get((kind, key))
+        if not windows:
+            windows = (RollingWindow(HOUR, 60), RollingWindow(DAY, 900))
+            self.windows[(kind, key)] = windows
+        return windows
+
+    def _add(self, fossa_id: str, wallet: str, amount: int, at: float) -> None:
+        for kind, key in (("fossa", fossa_id), ("wallet", wallet)):
+            for window in self._windows(kind, key):
+                window.add(amount, at)
+
+    async def ensure_loaded(self) -> None:
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            since = now_ms() - DAY * 1000
+            for row in await get_claimed_fossa_payment_amounts(since):
+                self.fossa_wallets[row["fossa_id"]] = row["wallet"]
+                self._add(row["fossa_id"], row["wallet"], row["amount"], row["at"])
+            self.loaded = True
+            logger.debug(f"Fossa withdraw limits loaded for {len(self.windows)} keys")
+
+    def check(self, fossa: Fossa, amount: int) -> str | None:
+        """Returns the reason if withdrawing `amount` sats would exceed a limit."""
+        now = time()
+        fossa_hourly, fossa_daily = self._windows("fossa", fossa.id)
+        wallet_hourly, wallet_daily = self._windows("wallet", fossa.wallet)
+        totals = {
+            "fossa_hourly": fossa_hourly.sum(now),
+            "fossa_daily": fossa_daily.sum(now),
+            "wallet_hourly": wallet_hourly.sum(now),
+            "wallet_daily": wallet_daily.sum(now),
+        }
+        return limit_reason(fossa, {k: v + amount for k, v in totals.items()})
+
+    async def verify_claim(
+        self, fossa: Fossa, fossa_payment_id: str, amount: int
+    ) -> str | None:
+        """
+        Check the limits against the claims of all workers, call right after
+        claiming. If one is exceeded the claim and its reservation are undone
+        and the reason is returned. Concurrent claims over a limit can reject
+        each other, but never get through together.
+        """
+        if not any(
+            (
+                fossa.hourly_limit,
+                fossa.daily_limit,
+                fossa.wallet_hourly_limit,
+                fossa.wallet_daily_limit,
+            )
+        ):
+            return None
+        now = now_ms()
+        totals = await get_claimed_fossa_payment_totals(
+            fossa.id, fossa.wallet, now - HOUR * 1000, now - DAY * 1000
+        )
+        reason = limit_reason(fossa, totals)
+        if reason:
+            await release_fossa_payments([fossa_payment_id])
+            self.release(fossa.id, amount)
+        return reason
+
+    async def reserve(self, fossa: Fossa, amount: int) -> str | None:
+        """
+        Check and count a withdraw in one step, call when claiming a payment.
+        Returns the reason if a limit is exceeded, nothing is counted then.
+        """
+        await self.ensure_loaded()
+        reason = self.check(fossa, amount)
+        if reason:
+            return reason
+        self.fossa_wallets[fossa.id] = fossa.wallet
+        self._add(fossa.id, fossa.wallet, amount, time())
+        return None
+
+    def release(self, fossa_id: str, amount: int, at: float | None = None) -> None:
+        """Uncount a withdraw that failed and was released."""
+        wallet = self.fossa_wallets.get(fossa_id)
+        if not self.loaded or not wallet:
+            return
+        self._add(fossa_id, wallet, -amount, at or time())
+
+
+def limit_reason(fossa: Fossa, totals: dict[str, int]) -> str | None:
+    """Reason if hourly and daily `totals` of the fossa and wallet exceed a limit."""
+    checks = (
+        ("fossa_hourly", fossa.hourly_limit, "Hourly", "ATM"),
+        ("fossa_daily", fossa.daily_limit, "Daily", "ATM"),
+        ("wallet_hourly", fossa.wallet_hourly_limit, "Hourly", "wallet"),
+        ("wallet_daily", fossa.wallet_daily_limit, "Daily", "wallet"),
+    )
+    for key, limit, period, name in checks:
+        if limit and totals[key] > limit:
+            return f"{period} withdraw limit of this {name} reached."
+    return None
+
+
+withdraw_limits = WithdrawLimits()
@@ -1,4 +1,4 @@
-from lnbits.db import Database
+from lnbits.db import SQLITE, Database
 
 db = Database("ext_fossa")
 
@@ -43,3 +43,206 @@ async def m002_addcolumn_amount(db):
         ADD COLUMN amount FLOAT NOT NULL DEFAULT 0;
         """
     )
+
+
+async def m003_coordination(db):
+    """
+    Leases and change versions to coordinate multiple lnbits workers.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE fossa.lease (
+            id TEXT NOT NULL PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at {db.big_int} NOT NULL
+        );
+    """
+    )
+    await db.execute(
+        """
+        CREATE TABLE fossa.change_version (
+            name TEXT NOT NULL PRIMARY KEY,
+            version INT NOT NULL DEFAULT 0
+        );
+    """
+    )
+    await db.execute(
+        "INSERT INTO fossa.change_version (name, version) VALUES ('fossa', 0)"
+    )
+
+
+async def m004_fossa_payment_change_version(db):
+    """
+    Change channel for payments, e.g. to drop cached receipts on all workers.
+    """
+    await db.execute(
+        """
+        INSERT INTO fossa.change_version (name, version)
+        VALUES ('fossa_payment', 0)
+        """
+    )
+
+
+async def m005_swap(db):
+    """
+    Boltz swaps started by the atms, polled until they are resolved.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE fossa.swap (
+            id TEXT NOT NULL PRIMARY KEY,
+            fossa_payment_id TEXT NOT NULL,
+            wallet TEXT NOT NULL,
+            status TEXT NOT NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            next_check {db.big_int},
+            timestamp TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+    # sqlite wants the schema on the index name instead of the table
+    if db.type == SQLITE:
+        index = "CREATE INDEX fossa.idx_fossa_swap_next_check ON swap (next_check)"
+    else:
+        index = "CREATE INDEX idx_fossa_swap_next_check ON fossa.swap (next_check)"
+    await db.execute(index)
+    # swaps started before the tracker existed, `pending_swap_<swap id>`
+    await db.execute(
+        """
+        INSERT INTO fossa.swap (id, fossa_payment_id, wallet, status, next_check)
+        SELECT SUBSTR(p.payment_hash, 14), p.id, f.wallet, 'swap.created', 0
+        FROM fossa.fossa_payment p JOIN fossa.fossa f ON f.id = p.fossa_id
+        WHERE SUBSTR(p.payment_hash, 1, 13) = 'pending_swap_'
+        """
+    )
+
+
+async def m006_withdraw_limits(db):
+    """
+    Hourly and daily withdraw limits per fossa and per wallet, in sats.
+    """
+    for column in (
+        "hourly_limit",
+        "daily_limit",
+        "wallet_hourly_limit",
+        "wallet_daily_limit",
+    ):
+        await db.execute(
+            f"ALTER TABLE fossa.fossa ADD COLUMN {column} INT NOT NULL DEFAULT 0;"
+        )
+
+
+async def m007_withdraw_outcome(db):
+    """
+    Outcome of successful withdraws, keyed by the fossa_payment id.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE fossa.withdraw_outcome (
+            id TEXT NOT NULL PRIMARY KEY,
+            destination TEXT NOT NULL,
+            payment_hash TEXT NOT NULL,
+            response TEXT NOT NULL,
+            timestamp TIMESTAMP NOT NULL DEFAULT {db.timestamp_now}
+        );
+    """
+    )
+
+
+async def m008_drop_payment_payload(db):
+    """
+    The payload url is derived from fossa_id and id, stop storing it.
+    """
+    await db.execute("ALTER TABLE fossa.fossa_payment DROP COLUMN payload;")
+
+
+async def m009_updated_at(db):
+    """
+    Change time of devices and payments plus tombstones of deleted rows, for
+    syncing only what changed since a cursor.
+    """
+    for table in ("fossa", "fossa_payment"):
+        await db.execute(
+            f"ALTER TABLE fossa.{table} ADD COLUMN updated_at {db.big_int} "
+            "NOT NULL DEFAULT 0;"
+        )
+    await db.execute(
+        f"""
+        CREATE TABLE fossa.tombstone (
+            kind TEXT NOT NULL,
+            id TEXT NOT NULL,
+            wallet TEXT NOT NULL,
+            deleted_at {db.big_int} NOT NULL,
+            PRIMARY KEY (kind, id)
+        );
+    """
+    )
+    for table, column in (
+        ("fossa", "updated_at"),
+        ("fossa_payment", "updated_at"),
+        ("tombstone", "deleted_at"),
+    ):
+        name = f"idx_fossa_{table}_{column}"
+        # sqlite wants the schema on the index name instead of the table
+        if db.type == SQLITE:
+            index = f"CREATE INDEX fossa.{name} ON {table} ({column})"
+        else:
+            index = f"CREATE INDEX {name} ON fossa.{table} ({column})"
+        await db.execute(index)
+
+
+async def m010_payment_event(db):
+    """
+    Append-only journal of fossa payment lifecycle changes.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE fossa.payment_event (
+            id {db.serial_primary_key},
+            fossa_payment_id TEXT NOT NULL,
+            fossa_id TEXT NOT NULL,
+            event TEXT NOT NULL,
+            detail TEXT,
+            created_at {db.big_int} NOT NULL
+        );
+    """
+    )
+    # sqlite wants the schema on the index name instead of the table
+    if db.type == SQLITE:
+        index = (
+            "CREATE INDEX fossa.idx_fossa_payment_event_payment "
+            "ON payment_event (fossa_payment_id)"
+        )
+    else:
+        index = (
+            "CREATE INDEX idx_fossa_payment_event_payment "
+            "ON fossa.payment_event (fossa_payment_id)"
+        )
+    await db.execute(index)
+
+
+async def m011_rate_snapshot(db):
+    """
+    Exchange rate used by withdraws, one row per currency and minute, so fiat
+    reports on past payments need no historical rates.
+    """
+    await db.execute(
+        f"""
+        CREATE TABLE fossa.rate_snapshot (
+            id {db.serial_primary_key},
+            currency TEXT NOT NULL,
+            minute {db.big_int} NOT NULL,
+            price_cents {db.big_int} NOT NULL,
+            UNIQUE (currency, minute)
+        );
+    """
+    )
+    await db.execute("ALTER TABLE fossa.fossa_payment ADD COLUMN rate_snapshot_id INT;")
+
+
+async def m012_swap_onchain_address(db):
+    """
+    Address of swaps that timed out before boltz returned their id, the swap
+    tracker looks them up by it.
+    """
+    await db.execute("ALTER TABLE fossa.swap ADD COLUMN onchain_address TEXT;")
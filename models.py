@@ -1,7 +1,9 @@
 import json
+from collections.abc import Mapping
 from datetime import datetime, timezone
+from enum import Enum
+from typing import Any
 
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
 from lnurl.types import LnurlPayMetadata
 from pydantic import BaseModel, Field
 
@@ -22,6 +24,11 @@ class CreateFossa(BaseModel):
     currency: str
     profit: float
     boltz: bool = False
+    # withdraw limits in sats, 0 means no limit
+    hourly_limit: int = 0
+    daily_limit: int = 0
+    wallet_hourly_limit: int = 0
+    wallet_daily_limit: int = 0
 
 
 class Fossa(BaseModel):
@@ -32,28 +39,256 @@ class Fossa(BaseModel):
     profit: float
     currency: str
     boltz: bool
+    hourly_limit: int = 0
+    daily_limit: int = 0
+    wallet_hourly_limit: int = 0
+    wallet_daily_limit: int = 0
+    # unix time in ms of the last change, see `/api/v1/changes`
+    updated_at: int = 0
 
     @property
     def lnurlpay_metadata(self) -> LnurlPayMetadata:
         return LnurlPayMetadata(json.dumps([["text/plain", self.title]]))
 
-    async def amount_to_sats(self, amount: float) -> int:
-        sats = (
-            int(amount)
-            if self.currency == "sat"
-            else await fiat_amount_as_satoshis(float(amount) / 100, self.currency)
-        )
-        if self.profit <= 0:
-            return sats
-        return int(sats - ((sats / 100) * self.profit))
+
+class FossaQuote(BaseModel):
+    """Price of a voucher, `price_msat` is `payout_msat` plus `fee_msat`."""
+
+    # value of the voucher amount
+    price_msat: int
+    # what the customer withdraws, whole sats
+    payout_msat: int
+    # profit margin of the operator
+    fee_msat: int
+    # rate snapshot the price is based on, None for sat vouchers
+    rate_snapshot_id: int | None = None
+
+    @property
+    def price_sat(self) -> int:
+        return self.price_msat // 1000
+
+    @property
+    def payout_sat(self) -> int:
+        return self.payout_msat // 1000
 
 
 class FossaPayment(BaseModel):
     id: str
     fossa_id: str
     payment_hash: str | None = None
-    payload: str
+    # lnurl url of the voucher, not stored as it is derived from fossa_id and id
+    payload: str | None = Field(default=None, no_database=True)
     pin: int
     sats: int
     amount: float
     timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    updated_at: int = 0
+    rate_snapshot_id: int | None = None
+
+
+class WithdrawStatus(str, Enum):
+    PENDING = "pending"
+    RESOLVING = "resolving"
+    PAYING = "paying"
+    PAID = "paid"
+    FAILED = "failed"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class PaymentEventType(str, Enum):
+    SCANNED = "scanned"
+    CLAIMED = "claimed"
+    PAID = "paid"
+    FAILED = "failed"
+    REPLAYED = "replayed"
+    SWAP_STARTED = "swap_started"
+    SWAP_SETTLED = "swap_settled"
+    SWAP_FAILED = "swap_failed"
+    SETTLED = "settled"
+    RELEASED = "released"
+    DELETED = "deleted"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class PaymentEvent(BaseModel):
+    """Lifecycle change of a fossa payment, appended to the journal."""
+
+    id: int | None = None
+    fossa_payment_id: str
+    fossa_id: str
+    event: PaymentEventType
+    detail: str | None = None
+    # unix time in ms
+    created_at: int
+
+
+class CircuitState(str, Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __str__(self) -> str:
+        return self.value
+
+
+class CircuitStatus(BaseModel):
+    name: str
+    state: CircuitState
+    failures: int
+    # unix time the breaker opened
+    opened_at: float | None = None
+    # seconds until a request may probe the upstream again
+    retry_in: int = 0
+
+
+class FossaWithdrawJob(BaseModel):
+    id: str
+    status: WithdrawStatus
+
+
+class ReconcileReport(BaseModel):
+    settled: list[str] = []
+    released: list[str] = []
+    in_flight: list[str] = []
+    # left pending for the operator, an untagged payment may belong to them
+    unmatched: list[str] = []
+
+
+class FossaSwap(BaseModel):
+    id: str
+    fossa_payment_id: str
+    wallet: str
+    status: str = "swap.created"
+    attempts: int = 0
+    # unix time of the next status poll, None once the swap is resolved
+    next_check: int | None = None
+    # set for a `lookup_<payment id>` swap, whose boltz id is not known yet
+    onchain_address: str | None = None
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+class FossaWithdrawOutcome(BaseModel):
+    """
+    Result of a successful withdraw, returned again when the atm retries. Stored
+    with `payment_hash` `pending` and no response while the withdraw is in flight.
+    """
+
+    id: str
+    # endpoint and destination of the withdraw, e.g. `ln:<invoice>`
+    destination: str
+    payment_hash: str
+    # json response of the first request
+    response: str
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+    @property
+    def in_flight(self) -> bool:
+        return self.payment_hash == "pending"
+
+
+class Tombstone(BaseModel):
+    kind: str
+    id: str
+    wallet: str
+    deleted_at: int
+
+
+class FossaChanges(BaseModel):
+    """
+    Rows changed or deleted after `since`. Apply `deleted` before the changed
+    rows and pass `cursor` as `since` on the next call.
+    """
+
+    cursor: int
+    # the cursor was too old, drop local state and start over from these rows
+    reset: bool = False
+    fossas: list[Fossa] = []
+    fossa_payments: list[FossaPayment] = []
+    deleted: list[Tombstone] = []
+
+
+class ListRow:
+    """
+    Read-only row for bulk listings, a plain slotted object built straight from
+    the database row instead of a validated model. Subclasses declare the
+    fields of the model they stand in for as annotations, which also give the
+    `__slots__`.
+    """
+
+    __slots__: tuple[str, ...] = ()
+    _bools: tuple[str, ...] = ()
+    _datetimes: tuple[str, ...] = ()
+
+    def __init__(self, row: Mapping[str, Any]):
+        for key in self.__slots__:
+            setattr(self, key, row.get(key))
+        for key in self._bools:
+            setattr(self, key, bool(getattr(self, key)))
+        for key in self._datetimes:
+            value = getattr(self, key)
+            if isinstance(value, (int, float)):
+                setattr(self, key, datetime.fromtimestamp(value, timezone.utc))
+            elif isinstance(value, datetime):
+                setattr(self, key, value.replace(tzinfo=timezone.utc))
+
+    def dict(self) -> dict[str, Any]:
+        """Json ready, in the same format as the model."""
+        data = {key: getattr(self, key) for key in self.__slots__}
+        for key in self._datetimes:
+            if data[key] is not None:
+                data[key] = data[key].isoformat()
+        return data
+
+
+class FossaRow(ListRow):
+    _bools = ("boltz",)
+    _datetimes = ()
+
+    id: str
+    key: str
+    title: str
+    wallet: str
+    profit: float
+    currency: str
+    boltz: bool
+    hourly_limit: int
+    daily_limit: int
+    wallet_hourly_limit: int
+    wallet_daily_limit: int
+    updated_at: int
+
+    __slots__ = tuple(__annotations__)
+
+
+class FossaPaymentRow(ListRow):
+    _datetimes = ("timestamp",)
+
+    id: str
+    fossa_id: str
+    payment_hash: str | None
+    payload: str | None
+    pin: int
+    sats: int
+    amount: float
+    timestamp: datetime
+    updated_at: int
+    rate_snapshot_id: int | None
+
+    __slots__ = tuple(__annotations__)
+
+
+class FossaFiatReport(BaseModel):
+    """Withdraws of a fossa in one fiat currency, at the rates they were paid at."""
+
+    fossa_id: str
+    currency: str
+    payments: int
+    sats: int
+    fee_sats: int
+    # value of the vouchers and the operator margin, in `currency`
+    fiat_amount: float
+    fiat_fee: float
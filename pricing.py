@@ -0,0 +1,114 @@
+import asyncio
+from collections import OrderedDict
+from time import time
+
+from lnbits.utils import exchange_rates
+from loguru import logger
+
+from .breakers import CircuitOpenError, rates_breaker
+from .coordination import on_change
+from .crud import get_or_create_rate_snapshot
+from .models import Fossa, FossaQuote, LnurlDecrypted
+from .tracing import traced
+
+MSAT_PER_BTC = 100_000_000_000
+
+# a voucher keeps its price from the scan until it is withdrawn, so the amount
+# shown on the atm page and in the lnurl matches the one paid out
+QUOTE_TTL_SECONDS = 300
+QUOTE_CACHE_SIZE = 10_000
+
+_quotes: OrderedDict[str, tuple[float, FossaQuote]] = OrderedDict()
+# margins or currencies may have changed
+on_change("fossa", _quotes.clear)
+# latest (minute, snapshot id) per currency, saves the lookup within a minute
+_snapshots: dict[str, tuple[int, int]] = {}
+
+
+def price_withdraw(
+    amount: float, currency: str, profit: float, btc_price: float | None = None
+) -> FossaQuote:
+    """
+    Price a voucher of `amount` (sats, or cents of `currency`) at `btc_price`
+    (`currency` per BTC). All math is in integer msat, the payout is rounded
+    down to whole sats and the remainder goes to the fee.
+    """
+    if currency == "sat":
+        price_msat = int(amount) * 1000
+    else:
+        # cents per BTC, rounded to keep the division integer
+        btc_price_cents = round((btc_price or 0) * 100)
+        if btc_price_cents <= 0:
+            raise ValueError(f"Could not get exchange rate for {currency}.")
+        price_msat = int(amount) * MSAT_PER_BTC // btc_price_cents
+
+    # profit in basis points, negative margins are ignored like before
+    profit_bps = max(round(profit * 100), 0)
+    payout_msat = price_msat * (10_000 - profit_bps) // 10_000
+    payout_msat -= payout_msat % 1000
+    return FossaQuote(
+        price_msat=price_msat,
+        payout_msat=payout_msat,
+        fee_msat=price_msat - payout_msat,
+    )
+
+
+async def _btc_price(currency: str) -> float:
+    async def _fetch() -> float:
+        _, price = await exchange_rates.get_fiat_rate_and_price_satoshis(currency)
+        if price <= 0:
+            raise ValueError(f"Could not get exchange rate for {currency}.")
+        return price
+
+    try:
+        return await rates_breaker.call(_fetch)
+    except CircuitOpenError as e:
+        raise ValueError(str(e)) from e
+    except asyncio.TimeoutError as e:
+        raise ValueError("Exchange rate service did not respond in time.") from e
+
+
+async def _rate_snapshot(currency: str, btc_price: float) -> int | None:
+    """Snapshot of the rate used for a quote, deduplicated by minute."""
+    minute = int(time() // 60)
+    cached = _snapshots.get(currency)
+    if cached and cached[0] == minute:
+        return cached[1]
+    try:
+        snapshot_id = await get_or_create_rate_snapshot(
+            currency, minute, round(btc_price * 100)
+        )
+    except Exception as ex:
+        # reporting only, never block a withdraw on it
+        logger.warning(f"Fossa rate snapshot failed: {ex}")
+        return None
+    _snapshots[currency] = (minute, snapshot_id)
+    return snapshot_id
+
+
+@traced("quote")
+async def quote_withdraw(
+    fossa: Fossa, decrypted: LnurlDecrypted, payload: str | None = None
+) -> FossaQuote:
+    """
+    Price a decrypted voucher of `fossa` with a single rate lookup. With the
+    voucher `payload` the quote is reused by the next steps of the withdraw.
+    Raises `ValueError` with a message for the atm if no rate is available.
+    """
+    key = f"{fossa.id}:{payload}"
+    cached = _quotes.get(key) if payload else None
+    if cached and cached[0] > time():
+        return cached[1]
+
+    btc_price = None
+    if fossa.currency != "sat":
+        btc_price = await _btc_price(fossa.currency)
+    quote = price_withdraw(decrypted.amount, fossa.currency, fossa.profit, btc_price)
+    if btc_price:
+        quote.rate_snapshot_id = await _rate_snapshot(fossa.currency, btc_price)
+    if payload:
+        _quotes[key] = (time() + QUOTE_TTL_SECONDS, quote)
+        _quotes.move_to_end(key)
+        while len(_quotes) > QUOTE_CACHE_SIZE:
+            _quotes.popitem(last=False)
+    return quote
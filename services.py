@@ -0,0 +1,169 @@
+from datetime import timedelta
+
+from lnbits.core.models import Payment
+from loguru import logger
+
+from .crud import (
+    get_core_fossa_payments,
+    get_fossa,
+    get_fossa_payments_changed,
+    get_fossas_changed,
+    get_pending_fossa_payments,
+    get_recorded_payment_hashes,
+    get_tombstones,
+    now_ms,
+    release_fossa_payments,
+    settle_fossa_payments,
+)
+from .journal import payment_journal
+from .limits import withdraw_limits
+from .models import FossaChanges, FossaPayment, PaymentEventType, ReconcileReport
+
+# payments claimed more recently are most likely still being paid
+RECONCILE_MIN_AGE_SECONDS = 600
+# lower bound for on demand runs, a claim may still be resolving the lnurl
+# before its core payment exists
+RECONCILE_MIN_AGE_FLOOR_SECONDS = 120
+
+# rows changed shortly before a cursor are sent again, catching writes that
+# committed after a previous sync had already read past their `updated_at`
+SYNC_OVERLAP_MS = 2000
+# cursors older than this get a full resync
+TOMBSTONE_RETENTION_MS = 30 * 24 * 3600 * 1000
+
+
+def _pick_core_payment(current: Payment | None, new: Payment) -> Payment:
+    """A payload can be paid more than once after a release, prefer success."""
+    if not current:
+        return new
+    rank = {"success": 0, "pending": 1, "failed": 2}
+    if rank.get(new.status, 3) < rank.get(current.status, 3):
+        return new
+    return current
+
+
+def _match_untagged(
+    fossa_payment: FossaPayment, wallet: str | None, untagged: list[Payment]
+) -> tuple[Payment | None, bool]:
+    """
+    Find the payment of a voucher paid before the lnurl callback tagged its
+    payments with the id, by wallet, amount and time. Returns the payment, if
+    exactly one fits, and whether any untagged payment could belong to it.
+    """
+    since = fossa_payment.timestamp - timedelta(minutes=1)
+    candidates = [p for p in untagged if p.wallet_id == wallet and p.time >= since]
+    matches = [p for p in candidates if -p.amount == fossa_payment.amount * 1000]
+    if len(matches) == 1:
+        untagged.remove(matches[0])
+        return matches[0], True
+    return None, len(candidates) > 0
+
+
+async def reconcile_pending_payments(
+    min_age_seconds: int = RECONCILE_MIN_AGE_SECONDS,
+    fossa_ids: list[str] | None = None,
+) -> ReconcileReport:
+    """
+    Settle or release fossa payments that are stuck in `pending` since their
+    claim, e.g. after a restart while an invoice was being paid. The outcome is
+    looked up in the core payments tagged with the fossa payment id, or for
+    payments from before the upgrade by wallet, amount and time.
+    """
+    older_than = now_ms() - min_age_seconds * 1000
+    pending = await get_pending_fossa_payments(older_than, fossa_ids)
+    report = ReconcileReport()
+    if len(pending) == 0:
+        return report
+
+    since = min(p.timestamp for p in pending) - timedelta(minutes=1)
+    core_payments: dict[str, Payment] = {}
+    untagged: list[Payment] = []
+    for payment in await get_core_fossa_payments(since):
+        fossa_payment_id = payment.extra.get("id")
+        if fossa_payment_id:
+            core_payments[fossa_payment_id] = _pick_core_payment(
+                core_payments.get(fossa_payment_id), payment
+            )
+        else:
+            untagged.append(payment)
+    if untagged:
+        # untagged payments of vouchers that did settle are accounted for
+        recorded = await get_recorded_payment_hashes([p.payment_hash for p in untagged])
+        untagged = [p for p in untagged if p.payment_hash not in recorded]
+    wallets: dict[str, str | None] = {}
+
+    settled: dict[str, str] = {}
+    for fossa_payment in sorted(pending, key=lambda p: p.timestamp):
+        core_payment = core_payments.get(fossa_payment.id)
+        if not core_payment and untagged:
+            if fossa_payment.fossa_id not in wallets:
+                fossa = await get_fossa(fossa_payment.fossa_id)
+                wallets[fossa_payment.fossa_id] = fossa.wallet if fossa else None
+            core_payment, candidates = _match_untagged(
+                fossa_payment, wallets[fossa_payment.fossa_id], untagged
+            )
+            if not core_payment and candidates:
+                # releasing could let a paid voucher be withdrawn again
+                report.unmatched.append(fossa_payment.id)
+                continue
+        if core_payment and core_payment.success:
+            settled[fossa_payment.id] = core_payment.payment_hash
+        elif core_payment and core_payment.pending:
+            report.in_flight.append(fossa_payment.id)
+        else:
+            report.released.append(fossa_payment.id)
+    report.settled = list(settled.keys())
+
+    await settle_fossa_payments(settled)
+    await release_fossa_payments(report.released)
+    for fossa_payment in pending:
+        if fossa_payment.id in settled:
+            payment_journal.record(
+                fossa_payment.id,
+                fossa_payment.fossa_id,
+                PaymentEventType.SETTLED,
+                settled[fossa_payment.id],
+            )
+        elif fossa_payment.id in report.released:
+            payment_journal.record(
+                fossa_payment.id, fossa_payment.fossa_id, PaymentEventType.RELEASED
+            )
+            # counted at the claim, which set `updated_at`
+            withdraw_limits.release(
+                fossa_payment.fossa_id,
+                int(fossa_payment.amount),
+                fossa_payment.updated_at / 1000,
+            )
+    if report.settled or report.released:
+        logger.info(
+            f"Fossa reconciled pending payments: {len(report.settled)} settled, "
+            f"{len(report.released)} released, {len(report.in_flight)} in flight."
+        )
+    if report.unmatched:
+        logger.warning(
+            f"Fossa payments {', '.join(report.unmatched)} may have been paid by an "
+            "untagged payment, check and release or settle them manually."
+        )
+    return report
+
+
+async def get_changes(wallet_ids: list[str], since: int = 0) -> FossaChanges:
+    """Devices and payments of `wallet_ids` changed or deleted after `since`."""
+    reset = 0 < since < now_ms() - TOMBSTONE_RETENTION_MS
+    if reset:
+        since = 0
+    after = since - SYNC_OVERLAP_MS if since else -1
+    changes = FossaChanges(
+        cursor=since,
+        reset=reset,
+        fossas=await get_fossas_changed(wallet_ids, after),
+        fossa_payments=await get_fossa_payments_changed(wallet_ids, after),
+        deleted=[] if reset else await get_tombstones(wallet_ids, after),
+    )
+    changes.cursor = max(
+        [since]
+        + [fossa.updated_at for fossa in changes.fossas]
+        + [fossa_payment.updated_at for fossa_payment in changes.fossa_payments]
+        + [tombstone.deleted_at for tombstone in changes.deleted]
+    )
+    return changes
@@ -0,0 +1,236 @@
+"""
+Fleet simulator, emulates many FOSSA devices handing out vouchers and replays
+the withdraw traffic against a running LNbits instance.
+
+    python -m fossa.simulator --url http://127.0.0.1:5000 \\
+        --admin-key <adminkey> --wallet <wallet_id> \\
+        --receive-key <invoicekey of another wallet> \\
+        --devices 200 --rate 20 --duration 60 --currencies sat,USD,EUR
+
+Without `--receive-key` only the LNURL scan step is exercised, with it every
+voucher is withdrawn either through the LNURL callback or `/api/v1/ln/...`.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from dataclasses import dataclass, field
+
+import httpx
+from lnbits.utils.crypto import AESCipher
+from lnurl import url_encode
+
+from .helpers import aes_decrypt_payload, parse_lnurl_payload
+
+
+@dataclass
+class SimulatedFossa:
+    id: str
+    key: str
+    currency: str
+
+    def voucher(self, base_url: str, pin: int, amount: int) -> str:
+        """Encrypt `pin:amount` and LNURL encode it, like the firmware does."""
+        payload = AESCipher(self.key).encrypt(f"{pin}:{amount}".encode(), True)
+        url = f"{base_url}/fossa/api/v1/lnurl/{self.id}?p={payload}"
+        return url_encode(url)
+
+
+@dataclass
+class SimulatorStats:
+    started: float = field(default_factory=time.perf_counter)
+    latencies: dict[str, list[float]] = field(default_factory=dict)
+    errors: dict[str, int] = field(default_factory=dict)
+
+    def record(self, step: str, latency: float, ok: bool) -> None:
+        self.latencies.setdefault(step, []).append(latency)
+        if not ok:
+            self.errors[step] = self.errors.get(step, 0) + 1
+
+    def report(self) -> str:
+        elapsed = time.perf_counter() - self.started
+        lines = [f"{'step':<12}{'count':>8}{'err %':>8}{'req/s':>9}"]
+        lines[0] += f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        for step, latencies in self.latencies.items():
+            count = len(latencies)
+            error_rate = 100 * self.errors.get(step, 0) / count
+            p50, p95, p99 = (
+                percentile(latencies, q) * 1000 for q in (0.50, 0.95, 0.99)
+            )
+            lines.append(
+                f"{step:<12}{count:>8}{error_rate:>8.1f}{count / elapsed:>9.1f}"
+                f"{p50:>9.1f}{p95:>9.1f}{p99:>9.1f}"
+            )
+        return "\n".join(lines)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * len(ordered)) - 1))
+    return ordered[index]
+
+
+def random_amount(currency: str) -> int:
+    """Sats for `sat` devices, cents for fiat devices."""
+    if currency == "sat":
+        return random.randint(100, 50_000)
+    return random.choice([500, 1000, 2000, 5000])
+
+
+class FleetSimulator:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.base_url = args.url.rstrip("/")
+        self.stats = SimulatorStats()
+        self.fossas: list[SimulatedFossa] = []
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            timeout=args.timeout,
+            limits=httpx.Limits(max_connections=args.concurrency),
+        )
+
+    async def _timed(self, step: str, method: str, url: str, **kwargs) -> dict:
+        start = time.perf_counter()
+        ok = False
+        data: dict = {}
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            data = response.json()
+            ok = response.is_success and (
+                not isinstance(data, dict) or data.get("status") != "ERROR"
+            )
+        except (httpx.HTTPError, ValueError):
+            pass
+        self.stats.record(step, time.perf_counter() - start, ok)
+        return data if ok and isinstance(data, dict) else {}
+
+    async def create_fossas(self) -> None:
+        currencies = self.args.currencies.split(",")
+        headers = {"X-Api-Key": self.args.admin_key}
+        for i in range(self.args.devices):
+            data = await self._timed(
+                "create",
+                "POST",
+                "/fossa/api/v1/fossa",
+                headers=headers,
+                json={
+                    "title": f"simulated fossa {i}",
+                    "wallet": self.args.wallet,
+                    "currency": currencies[i % len(currencies)],
+                    "profit": self.args.profit,
+                },
+            )
+            if data:
+                self.fossas.append(
+                    SimulatedFossa(data["id"], data["key"], data["currency"])
+                )
+
+    async def delete_fossas(self) -> None:
+        headers = {"X-Api-Key": self.args.admin_key}
+        for fossa in self.fossas:
+            await self.client.delete(f"/fossa/api/v1/fossa/{fossa.id}", headers=headers)
+
+    async def _invoice(self, sats: int) -> str | None:
+        data = await self._timed(
+            "invoice",
+            "POST",
+            "/api/v1/payments",
+            headers={"X-Api-Key": self.args.receive_key},
+            json={"out": False, "amount": sats, "memo": "fossa simulator"},
+        )
+        return data.get("bolt11") or data.get("payment_request")
+
+    async def withdraw(self, fossa: SimulatedFossa) -> None:
+        lnurl = fossa.voucher(
+            self.base_url, random.randint(1000, 9999), random_amount(fossa.currency)
+        )
+        lnurl_payload = parse_lnurl_payload(lnurl)
+        params = await self._timed(
+            "scan",
+            "GET",
+            f"/fossa/api/v1/lnurl/{fossa.id}",
+            params={"p": lnurl_payload.payload},
+        )
+        if not params or not self.args.receive_key:
+            return
+        pr = await self._invoice(int(params["maxWithdrawable"]) // 1000)
+        if not pr:
+            return
+        if random.random() < self.args.ln_share:
+            await self._timed("ln", "GET", f"/fossa/api/v1/ln/{lnurl}/{pr}")
+        else:
+            await self._timed(
+                "callback",
+                "GET",
+                params["callback"],
+                params={"k1": params["k1"], "pr": pr},
+            )
+
+    async def run(self) -> None:
+        await self.create_fossas()
+        if not self.fossas:
+            raise SystemExit("No devices could be created, check url and keys.")
+        # sanity check, vouchers must be readable by the extension helpers
+        sample = self.fossas[0]
+        aes_decrypt_payload(
+            parse_lnurl_payload(sample.voucher(self.base_url, 1, 1)).payload,
+            sample.key,
+        )
+
+        self.stats = SimulatorStats()
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        tasks: set[asyncio.Task] = set()
+
+        async def _limited(fossa: SimulatedFossa) -> None:
+            async with semaphore:
+                await self.withdraw(fossa)
+
+        deadline = time.perf_counter() + self.args.duration
+        while time.perf_counter() < deadline:
+            task = asyncio.create_task(_limited(random.choice(self.fossas)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            # poisson arrivals
+            await asyncio.sleep(random.expovariate(self.args.rate))
+        await asyncio.gather(*tasks)
+        print(self.stats.report())
+
+        if self.args.cleanup:
+            await self.delete_fossas()
+        await self.client.aclose()
+
+
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Simulate a fleet of FOSSA ATMs.")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--admin-key", required=True, help="adminkey of --wallet")
+    parser.add_argument("--wallet", required=True, help="wallet id funding the ATMs")
+    parser.add_argument(
+        "--receive-key", help="invoice key of the wallet receiving withdraws"
+    )
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=10, help="vouchers per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--currencies", default="sat,USD,EUR")
+    parser.add_argument("--profit", type=float, default=2)
+    parser.add_argument(
+        "--ln-share",
+        type=float,
+        default=0.5,
+        help="share of withdraws using /api/v1/ln instead of the lnurl callback",
+    )
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--cleanup", action="store_true", help="delete devices after")
+    return parser.parse_args(argv)
+
+
+def main(argv: list[str] | None = None) -> None:
+    asyncio.run(FleetSimulator(parse_args(argv)).run())
+
+
+if __name__ == "__main__":
+    main()
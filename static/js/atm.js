@@ -6,6 +6,7 @@ window.app = Vue.createApp({
     return {
       fossa_id: fossa_id,
       lnurl: lnurl,
+      payment_id: payment_id,
       boltz: boltz,
       amount_sat: amount_sat,
       used: used,
@@ -19,22 +20,60 @@ window.app = Vue.createApp({
   },
   methods: {
     async sendLNaddress() {
+      // listen before requesting so no status update is missed
+      await this.connectWithdrawWebsocket(this.payment_id)
       try {
         const response = await LNbits.api.request(
           'GET',
-          `/fossa/api/v1/ln/${lnurl}/${this.ln}`,
+          `/fossa/api/v1/ln/${lnurl}/${this.ln}?background=true`,
           ''
         )
-        if (response.data) {
+        if (response.data && response.data.status === 'paid') {
+          // a retry of a finished withdraw, no status update follows
+          this.onWithdrawStatus('paid')
+        } else if (response.data) {
           this.ln = ''
           this.notifyUser('Payment should be with you shortly', 'positive')
-          this.connectWebsocket(payment_id)
         }
-        window.location.reload()
       } catch (error) {
+        this.closeWithdrawWebsocket()
         LNbits.utils.notifyApiError(error)
       }
     },
+    connectWithdrawWebsocket(job_id) {
+      // resolves once the socket is open, updates are only sent to open sockets.
+      // without a socket the withdraw still goes ahead, just without updates
+      const protocol = location.protocol === 'https:' ? 'wss://' : 'ws://'
+      const localUrl = `${protocol}${document.domain}:${location.port}/api/v1/ws/${job_id}`
+      this.closeWithdrawWebsocket()
+      const connection = new WebSocket(localUrl)
+      this.withdrawConnection = connection
+      connection.onmessage = ({data}) => this.onWithdrawStatus(data)
+      return new Promise(resolve => {
+        connection.onopen = resolve
+        connection.onerror = resolve
+      })
+    },
+    onWithdrawStatus(status) {
+      if (status === 'resolving') {
+        this.notifyUser('Resolving payment request...', 'positive')
+      } else if (status === 'paying') {
+        this.notifyUser('Paying...', 'positive')
+      } else if (status === 'paid') {
+        this.closeWithdrawWebsocket()
+        this.notifyUser('Payment sent!', 'positive')
+        window.location.reload()
+      } else if (status === 'failed') {
+        this.closeWithdrawWebsocket()
+        this.notifyUser('Withdraw failed, try again later', 'negative')
+      }
+    },
+    closeWithdrawWebsocket() {
+      if (this.withdrawConnection) {
+        this.withdrawConnection.close()
+        this.withdrawConnection = null
+      }
+    },
     sendOnchainAddress() {
       this.onchain_liquid = 'BTCtempBTC'
       this.sendAddress()
@@ -44,6 +83,8 @@ window.app = Vue.createApp({
       this.sendAddress()
     },
     async sendAddress() {
+      // swap progress is pushed on the payment id
+      await this.connectWithdrawWebsocket(this.payment_id)
       try {
         const response = await LNbits.api.request(
           'GET',
@@ -57,19 +98,11 @@ window.app = Vue.createApp({
             'positive'
           )
         }
-        this.connectWebsocket(websocket_id)
       } catch (error) {
+        this.closeWithdrawWebsocket()
         LNbits.utils.notifyApiError(error)
       }
     },
-    connectWebsocket(websocket_id) {
-      const protocol = location.protocol === 'https:' ? 'wss://' : 'ws://'
-      const localUrl = `${protocol}${document.domain}:${location.port}/api/v1/ws/${websocket_id}` // Ensure review_id is defined or passed correctly
-      this.connection = new WebSocket(localUrl)
-      this.connection.onmessage = () => {
-        this.notifyUser('Payment sent!', 'positive')
-      }
-    },
     notifyUser(message, type) {
       this.$q.notify({
         message,
@@ -119,6 +119,14 @@ window.app = Vue.createApp({
       if (!this.formDialog.data.profit) {
         this.formDialog.data.profit = 0
       }
+      for (const limit of [
+        'hourly_limit',
+        'daily_limit',
+        'wallet_hourly_limit',
+        'wallet_daily_limit'
+      ]) {
+        this.formDialog.data[limit] = parseInt(this.formDialog.data[limit]) || 0
+      }
       if (this.formDialog.data.id) {
         this.updateFossa(this.g.user.wallets[0].adminkey, this.formDialog.data)
       } else {
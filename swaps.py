@@ -0,0 +1,274 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from time import time
+
+import httpx
+from lnbits.core.crud import get_wallet
+from lnbits.core.services import websocket_updater
+from lnbits.settings import settings
+from loguru import logger
+
+from .breakers import CircuitOpenError, boltz_status_breaker
+from .coordination import is_leader
+from .crud import (
+    create_fossa_swap,
+    delete_withdraw_outcome,
+    get_due_fossa_swaps,
+    get_fossa_payment,
+    get_fossa_swap,
+    schedule_fossa_swap_check,
+    update_fossa_payment,
+    update_fossa_swap,
+)
+from .journal import payment_journal
+from .limits import withdraw_limits
+from .models import FossaSwap, PaymentEventType, WithdrawStatus
+
+SWAP_POLL_INTERVAL_SECONDS = 5
+SWAP_POLL_BATCH_SIZE = 50
+SWAP_POLL_CONCURRENCY = 5
+SWAP_BACKOFF_BASE_SECONDS = 5
+SWAP_BACKOFF_MAX_SECONDS = 600
+# swaps unresolved after this are left for the operator
+SWAP_MAX_AGE = timedelta(hours=24)
+# a withdraw whose swap request timed out is released if boltz has no swap to
+# its address after this
+SWAP_LOOKUP_GRACE = timedelta(minutes=10)
+
+# boltz reverse swap states
+SWAP_SUCCESS_STATUSES = {"invoice.settled", "transaction.claimed"}
+SWAP_FAILED_STATUSES = {
+    "swap.expired",
+    "invoice.expired",
+    "invoice.failedToPay",
+    "transaction.failed",
+    "transaction.refunded",
+}
+
+_wake = asyncio.Event()
+
+
+def swap_backoff(attempts: int) -> int:
+    return min(SWAP_BACKOFF_BASE_SECONDS * 2**attempts, SWAP_BACKOFF_MAX_SECONDS)
+
+
+async def check_swap_soon(swap_id: str) -> None:
+    """Poll a tracked swap on the next run, e.g. when its invoice got paid."""
+    if await schedule_fossa_swap_check(swap_id, int(time())):
+        _wake.set()
+
+
+def _parse_status(data: dict) -> str | None:
+    status = data.get("status")
+    if isinstance(status, dict):
+        status = status.get("status")
+    return status if isinstance(status, str) else None
+
+
+async def _fetch_status(client, swap: FossaSwap, adminkey: str) -> str | None:
+    response = await client.post(
+        url=f"http://{settings.host}:{settings.port}/boltz/api/v1/swap/status",
+        headers={"X-API-KEY": adminkey},
+        json={"swapId": swap.id},
+    )
+    response.raise_for_status()
+    return _parse_status(response.json())
+
+
+async def _fetch_reverse_swaps(client, adminkey: str) -> list[dict]:
+    response = await client.get(
+        url=f"http://{settings.host}:{settings.port}/boltz/api/v1/swap/reverse",
+        headers={"X-API-KEY": adminkey},
+    )
+    response.raise_for_status()
+    data = response.json()
+    return data if isinstance(data, list) else []
+
+
+async def _lookup_swap(client, swap: FossaSwap, adminkey: str | None) -> None:
+    """
+    Find the boltz swap of a withdraw whose swap request timed out by its
+    address and track it, or release the payment if boltz never created it.
+    """
+    fossa_payment = await get_fossa_payment(swap.fossa_payment_id)
+    if not fossa_payment or fossa_payment.payment_hash != "pending_boltz_timeout":
+        swap.next_check = None
+        await update_fossa_swap(swap)
+        return
+
+    candidates = None
+    if adminkey:
+        try:
+            candidates = await boltz_status_breaker.call(
+                lambda: _fetch_reverse_swaps(client, adminkey)
+            )
+        except CircuitOpenError:
+            pass
+        except Exception as ex:
+            logger.debug(f"Fossa swap lookup {swap.id} failed: {ex}")
+
+    # only decide on an answer from boltz
+    if candidates is not None:
+        for candidate in candidates:
+            if (
+                candidate.get("id")
+                and candidate.get("onchain_address") == swap.onchain_address
+                and int(candidate.get("amount") or 0) == int(fossa_payment.amount)
+                # swaps of earlier withdraws to the same address are tracked
+                and not await get_fossa_swap(str(candidate["id"]))
+            ):
+                found = FossaSwap(
+                    id=str(candidate["id"]),
+                    fossa_payment_id=fossa_payment.id,
+                    wallet=swap.wallet,
+                    next_check=int(time()),
+                    timestamp=swap.timestamp,
+                )
+                # hold the payment for the swap before tracking it
+                fossa_payment.payment_hash = f"pending_swap_{found.id}"
+                await update_fossa_payment(fossa_payment)
+                await create_fossa_swap(found)
+                payment_journal.record(
+                    fossa_payment.id,
+                    fossa_payment.fossa_id,
+                    PaymentEventType.SWAP_STARTED,
+                    f"{found.id}, found after timeout",
+                )
+                swap.status = "swap.found"
+                swap.next_check = None
+                await update_fossa_swap(swap)
+                _wake.set()
+                return
+
+        if swap.timestamp < datetime.now(timezone.utc) - SWAP_LOOKUP_GRACE:
+            fossa_payment.payment_hash = None
+            await update_fossa_payment(fossa_payment)
+            payment_journal.record(
+                fossa_payment.id,
+                fossa_payment.fossa_id,
+                PaymentEventType.RELEASED,
+                "no boltz swap after timeout",
+            )
+            await delete_withdraw_outcome(fossa_payment.id)
+            withdraw_limits.release(
+                fossa_payment.fossa_id,
+                int(fossa_payment.amount),
+                swap.timestamp.timestamp(),
+            )
+            await websocket_updater(fossa_payment.id, str(WithdrawStatus.FAILED))
+            swap.status = "swap.not_found"
+            swap.next_check = None
+            await update_fossa_swap(swap)
+            return
+
+    swap.attempts += 1
+    if swap.timestamp < datetime.now(timezone.utc) - SWAP_MAX_AGE:
+        logger.warning(f"Fossa swap lookup {swap.id} unresolved, stop tracking.")
+        swap.next_check = None
+    else:
+        swap.next_check = int(time()) + swap_backoff(swap.attempts)
+    await update_fossa_swap(swap)
+
+
+async def _resolve_swap(swap: FossaSwap, success: bool) -> None:
+    swap.next_check = None
+    await update_fossa_swap(swap)
+    fossa_payment = await get_fossa_payment(swap.fossa_payment_id)
+    if fossa_payment and fossa_payment.payment_hash == f"pending_swap_{swap.id}":
+        # release the payload again if the swap failed
+        fossa_payment.payment_hash = swap.id if success else None
+        await update_fossa_payment(fossa_payment)
+        payment_journal.record(
+            fossa_payment.id,
+            fossa_payment.fossa_id,
+            (
+                PaymentEventType.SWAP_SETTLED
+                if success
+                else PaymentEventType.SWAP_FAILED
+            ),
+            swap.status,
+        )
+        if not success:
+            await delete_withdraw_outcome(fossa_payment.id)
+            withdraw_limits.release(
+                fossa_payment.fossa_id,
+                int(fossa_payment.amount),
+                swap.timestamp.timestamp(),
+            )
+    status = WithdrawStatus.PAID if success else WithdrawStatus.FAILED
+    await websocket_updater(swap.fossa_payment_id, str(status))
+
+
+async def _check_swap(client, swap: FossaSwap, adminkey: str | None) -> None:
+    if swap.onchain_address:
+        await _lookup_swap(client, swap, adminkey)
+        return
+    status = None
+    if adminkey:
+        try:
+            status = await boltz_status_breaker.call(
+                lambda: _fetch_status(client, swap, adminkey)
+            )
+        except CircuitOpenError:
+            pass
+        except Exception as ex:
+            logger.debug(f"Fossa swap {swap.id} status failed: {ex}")
+
+    if status in SWAP_SUCCESS_STATUSES or status in SWAP_FAILED_STATUSES:
+        swap.status = status
+        await _resolve_swap(swap, status in SWAP_SUCCESS_STATUSES)
+        return
+
+    if status and status != swap.status:
+        swap.status = status
+        swap.attempts = 0
+        await websocket_updater(swap.fossa_payment_id, str(WithdrawStatus.PAYING))
+    else:
+        swap.attempts += 1
+
+    if swap.timestamp < datetime.now(timezone.utc) - SWAP_MAX_AGE:
+        logger.warning(f"Fossa swap {swap.id} unresolved, stop tracking.")
+        swap.next_check = None
+    else:
+        swap.next_check = int(time()) + swap_backoff(swap.attempts)
+    await update_fossa_swap(swap)
+
+
+async def check_due_swaps() -> int:
+    """Poll the status of all due swaps, returns the number of swaps checked."""
+    if not boltz_status_breaker.available():
+        # boltz is down, do not burn the backoff of every swap on it
+        return 0
+    swaps = await get_due_fossa_swaps(int(time()), SWAP_POLL_BATCH_SIZE)
+    if len(swaps) == 0:
+        return 0
+    adminkeys: dict[str, str | None] = {}
+    for wallet_id in {swap.wallet for swap in swaps}:
+        wallet = await get_wallet(wallet_id)
+        adminkeys[wallet_id] = wallet.adminkey if wallet else None
+
+    semaphore = asyncio.Semaphore(SWAP_POLL_CONCURRENCY)
+
+    async def _limited(swap: FossaSwap) -> None:
+        async with semaphore:
+            await _check_swap(client, swap, adminkeys[swap.wallet])
+
+    async with httpx.AsyncClient() as client:
+        await asyncio.gather(*[_limited(swap) for swap in swaps])
+    return len(swaps)
+
+
+async def track_swaps_task():
+    while True:
+        _wake.clear()
+        try:
+            if await is_leader("swaps", SWAP_POLL_INTERVAL_SECONDS * 6):
+                # keep going while full batches are due
+                while await check_due_swaps() == SWAP_POLL_BATCH_SIZE:
+                    pass
+        except Exception as ex:
+            logger.warning(f"Fossa swap tracker failed: {ex}")
+        try:
+            await asyncio.wait_for(_wake.wait(), SWAP_POLL_INTERVAL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
@@ -1,14 +1,17 @@
 import asyncio
 
-import httpx
-from lnbits.core.crud import get_wallet
 from lnbits.core.models import Payment
-from lnbits.core.services import websocket_updater
-from lnbits.settings import settings
 from lnbits.tasks import register_invoice_listener
 from loguru import logger
 
-from .crud import get_fossa, get_fossa_payment_by_hash, update_fossa_payment
+from .coordination import is_leader
+from .crud import delete_tombstones, now_ms
+from .services import TOMBSTONE_RETENTION_MS, reconcile_pending_payments
+from .swaps import check_swap_soon
+
+RECONCILE_INTERVAL_SECONDS = 300
+# non-critical jobs wait until lnbits is up and serving
+STARTUP_DELAY_SECONDS = 60
 
 
 async def wait_for_paid_invoices():
@@ -20,34 +23,24 @@ async def wait_for_paid_invoices():
         await on_invoice_paid(payment)
 
 
+async def reconcile_pending_payments_task():
+    await asyncio.sleep(STARTUP_DELAY_SECONDS)
+    while True:
+        try:
+            # only one worker reconciles when running several
+            if await is_leader("reconcile", RECONCILE_INTERVAL_SECONDS * 2):
+                await reconcile_pending_payments()
+                await delete_tombstones(now_ms() - TOMBSTONE_RETENTION_MS)
+        except Exception as ex:
+            logger.warning(f"Fossa reconcile failed: {ex}")
+        await asyncio.sleep(RECONCILE_INTERVAL_SECONDS)
+
+
 async def on_invoice_paid(payment: Payment) -> None:
-    logger.debug(f"Fossa received paid invoice: {payment}")
     if payment.extra.get("tag") != "boltz":
         return
-
     swap_id = payment.extra.get("swap_id")
-    logger.debug(f"Boltz swap_id: {swap_id}")
+    logger.debug(f"Fossa received paid boltz invoice, swap_id: {swap_id}")
     if swap_id:
-        fossa_payment = await get_fossa_payment_by_hash("pending_swap_" + swap_id)
-        if not fossa_payment:
-            return
-        fossa = await get_fossa(fossa_payment.fossa_id)
-        if not fossa:
-            return
-        wallet = await get_wallet(fossa.wallet)
-        if not wallet:
-            return
-        try:
-            async with httpx.AsyncClient() as client:
-                swap = await client.post(
-                    url=f"http://{settings.host}:{settings.port}/boltz/api/v1/swap/status",
-                    headers={"X-API-KEY": wallet.adminkey},
-                    json={"swapId": swap_id},
-                )
-            if swap:
-                fossa_payment.payment_hash = swap_id
-                await update_fossa_payment(fossa_payment)
-                await websocket_updater("pending_swap_" + swap_id, "Paid")
-                return
-        except Exception:
-            return
+        # let the swap tracker confirm the swap status right away
+        await check_swap_soon(swap_id)
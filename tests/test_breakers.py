@@ -0,0 +1,136 @@
+import asyncio
+
+import httpx
+import pytest
+
+from ..breakers import CircuitBreaker, CircuitOpenError, upstream_failure
+from ..models import CircuitState
+
+
+async def _fail():
+    raise RuntimeError("upstream down")
+
+
+async def _ok():
+    return "ok"
+
+
+async def _hang():
+    await asyncio.sleep(10)
+
+
+@pytest.mark.asyncio
+async def test_breaker_opens_and_fails_fast():
+    breaker = CircuitBreaker("test", timeout=1, failure_threshold=2, reset_seconds=60)
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            await breaker.call(_fail)
+    assert breaker.state == CircuitState.OPEN
+    assert not breaker.available()
+
+    called = False
+
+    async def _probe():
+        nonlocal called
+        called = True
+
+    with pytest.raises(CircuitOpenError, match="test is unavailable"):
+        await breaker.call(_probe)
+    assert not called
+
+
+@pytest.mark.asyncio
+async def test_breaker_half_open_probe():
+    breaker = CircuitBreaker("test", timeout=1, failure_threshold=1, reset_seconds=0)
+    with pytest.raises(RuntimeError):
+        await breaker.call(_fail)
+    assert breaker.state == CircuitState.OPEN
+
+    # after the reset a failed probe opens it again, a good one closes it
+    with pytest.raises(RuntimeError):
+        await breaker.call(_fail)
+    assert breaker.state == CircuitState.OPEN
+    assert await breaker.call(_ok) == "ok"
+    assert breaker.state == CircuitState.CLOSED
+    assert breaker.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_breaker_timeout_counts_as_failure():
+    breaker = CircuitBreaker("test", timeout=0.01, failure_threshold=1)
+    with pytest.raises(asyncio.TimeoutError):
+        await breaker.call(_hang)
+    assert breaker.state == CircuitState.OPEN
+    assert breaker.status().retry_in > 0
+
+
+@pytest.mark.asyncio
+async def test_breaker_ignores_answers_of_the_upstream():
+    breaker = CircuitBreaker("test", timeout=1, failure_threshold=1)
+
+    async def _unknown_address():
+        request = httpx.Request("GET", "https://wallet.example.com")
+        response = httpx.Response(404, request=request)
+        try:
+            response.raise_for_status()
+        except httpx.HTTPStatusError as exc:
+            # how the lnurl library wraps errors
+            raise ValueError(str(exc)) from exc
+
+    async def _connect_error():
+        try:
+            raise httpx.ConnectError("connection refused")
+        except httpx.ConnectError as exc:
+            raise ValueError("Failed to connect") from exc
+
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            await breaker.call(_unknown_address, upstream_failure)
+    assert breaker.state == CircuitState.CLOSED
+    assert not upstream_failure(ValueError("amount out of range"))
+
+    with pytest.raises(ValueError):
+        await breaker.call(_connect_error, upstream_failure)
+    assert breaker.state == CircuitState.OPEN
+
+
+@pytest.mark.asyncio
+async def test_breaker_counts_failures_of_the_lnurl_library(monkeypatch):
+    from lnurl import LnurlPayResponse, LnurlResponseException, execute_pay_request
+
+    pay_response = LnurlPayResponse(
+        callback="https://wallet.example.com/callback",
+        minSendable=1000,
+        maxSendable=1000000,
+        metadata='[["text/plain", "fossa"]]',
+    )
+    status_code = 503
+
+    async def _get(self, url, **kwargs):
+        if status_code is None:
+            raise httpx.ConnectError("connection refused")
+        request = httpx.Request("GET", url)
+        return httpx.Response(status_code, request=request)
+
+    monkeypatch.setattr(httpx.AsyncClient, "get", _get)
+    breaker = CircuitBreaker("test", timeout=1, failure_threshold=2)
+
+    async def _pay():
+        return await execute_pay_request(pay_response, 1000)
+
+    # the library re-raises 4xx and 5xx without `from`
+    status_code = 404
+    for _ in range(3):
+        with pytest.raises(LnurlResponseException):
+            await breaker.call(_pay, upstream_failure)
+    assert breaker.state == CircuitState.CLOSED
+
+    status_code = 503
+    with pytest.raises(LnurlResponseException):
+        await breaker.call(_pay, upstream_failure)
+    assert breaker.failures == 1
+
+    status_code = None
+    with pytest.raises(LnurlResponseException):
+        await breaker.call(_pay, upstream_failure)
+    assert breaker.state == CircuitState.OPEN
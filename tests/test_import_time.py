@@ -0,0 +1,38 @@
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+# cumulative import time of the extension itself, lnbits is imported beforehand.
+# measured around 65ms, the margin is for slower machines
+IMPORT_TIME_BUDGET_MS = 100
+IMPORT_RUNS = 3
+
+PRELOAD = "import fastapi, lnbits.core.services, lnbits.decorators, lnbits.helpers"
+
+
+def _import_time_ms(package: str, cwd: Path) -> float:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"{PRELOAD}; import {package}"],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    match = re.search(
+        rf"^import time:\s+\d+ \|\s+(\d+) \| {re.escape(package)}$",
+        result.stderr,
+        re.MULTILINE,
+    )
+    assert match, result.stderr[-2000:]
+    return int(match.group(1)) / 1000
+
+
+def test_import_time_budget():
+    package_dir = Path(__file__).resolve().parent.parent
+    package = __package__.rsplit(".", 1)[0]
+    # the fastest of a few runs, single runs are noisy on a busy machine
+    cumulative_ms = min(
+        _import_time_ms(package, package_dir.parent) for _ in range(IMPORT_RUNS)
+    )
+    assert cumulative_ms < IMPORT_TIME_BUDGET_MS
@@ -0,0 +1,35 @@
+import pytest
+
+from .. import journal
+from ..journal import JOURNAL_BATCH_SIZE, PaymentJournal
+from ..models import PaymentEvent, PaymentEventType
+
+
+@pytest.mark.asyncio
+async def test_journal_flushes_in_batches(monkeypatch):
+    batches: list[list[PaymentEvent]] = []
+
+    async def _write(events: list[PaymentEvent]) -> None:
+        batches.append(list(events))
+
+    monkeypatch.setattr(journal, "create_payment_events", _write)
+    payment_journal = PaymentJournal()
+    for i in range(JOURNAL_BATCH_SIZE + 1):
+        payment_journal.record(f"payment{i}", "fossa", PaymentEventType.SCANNED)
+    assert payment_journal._full.is_set()
+
+    assert await payment_journal.flush() == JOURNAL_BATCH_SIZE + 1
+    assert [len(batch) for batch in batches] == [JOURNAL_BATCH_SIZE, 1]
+    assert payment_journal.buffer == []
+
+
+@pytest.mark.asyncio
+async def test_journal_keeps_events_when_write_fails(monkeypatch):
+    async def _write(events: list[PaymentEvent]) -> None:
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(journal, "create_payment_events", _write)
+    payment_journal = PaymentJournal()
+    payment_journal.record("payment", "fossa", PaymentEventType.PAID, "hash")
+    assert await payment_journal.flush() == 0
+    assert len(payment_journal.buffer) == 1
@@ -0,0 +1,82 @@
+import pytest
+
+from .. import limits as limits_module
+from ..limits import RollingWindow, WithdrawLimits
+from ..models import Fossa
+
+
+def test_rolling_window_expires_old_buckets():
+    window = RollingWindow(3600, 60)
+    window.add(100, 0)
+    window.add(50, 1800)
+    assert window.sum(1800) == 150
+    assert window.sum(3600 + 60) == 50
+    assert window.sum(1800 + 3600 + 60) == 0
+
+
+@pytest.mark.asyncio
+async def test_withdraw_limits_reserve_and_release():
+    fossa = Fossa(
+        id="fossa",
+        key="key",
+        title="test",
+        wallet="wallet",
+        profit=0,
+        currency="sat",
+        boltz=False,
+        hourly_limit=1000,
+        wallet_daily_limit=1500,
+    )
+    limits = WithdrawLimits()
+    limits.loaded = True
+    assert await limits.reserve(fossa, 600) is None
+    assert await limits.reserve(fossa, 600) == (
+        "Hourly withdraw limit of this ATM reached."
+    )
+    limits.release(fossa.id, 600)
+    assert await limits.reserve(fossa, 1000) is None
+    fossa.hourly_limit = 0
+    assert await limits.reserve(fossa, 600) == (
+        "Daily withdraw limit of this wallet reached."
+    )
+
+
+@pytest.mark.asyncio
+async def test_withdraw_limits_verify_claim_across_workers(monkeypatch):
+    released: list[list[str]] = []
+
+    async def _totals(fossa_id, wallet, hour_since, day_since) -> dict[str, int]:
+        # claims of other workers this process has not counted
+        return {
+            "fossa_hourly": 1200,
+            "fossa_daily": 1200,
+            "wallet_hourly": 1200,
+            "wallet_daily": 1200,
+        }
+
+    async def _release(fossa_payment_ids: list[str]) -> None:
+        released.append(fossa_payment_ids)
+
+    monkeypatch.setattr(limits_module, "get_claimed_fossa_payment_totals", _totals)
+    monkeypatch.setattr(limits_module, "release_fossa_payments", _release)
+    fossa = Fossa(
+        id="fossa",
+        key="key",
+        title="test",
+        wallet="wallet",
+        profit=0,
+        currency="sat",
+        boltz=False,
+        hourly_limit=1000,
+    )
+    limits = WithdrawLimits()
+    limits.loaded = True
+    assert await limits.reserve(fossa, 600) is None
+    assert await limits.verify_claim(fossa, "payment", 600) == (
+        "Hourly withdraw limit of this ATM reached."
+    )
+    assert released == [["payment"]]
+    assert await limits.reserve(fossa, 1000) is None
+
+    fossa.hourly_limit = 0
+    assert await limits.verify_claim(fossa, "payment", 600) is None
@@ -0,0 +1,109 @@
+import random
+
+import pytest
+from lnbits.utils import exchange_rates
+
+from .. import pricing
+from ..models import Fossa, LnurlDecrypted
+from ..pricing import price_withdraw, quote_withdraw
+
+
+def _random_cases(count: int = 2000):
+    rng = random.Random(39)
+    for _ in range(count):
+        currency = rng.choice(["sat", "USD", "EUR"])
+        amount = rng.randint(0, 10_000_000)
+        profit = rng.choice([0, 0.5, 1, 2.5, 10, rng.uniform(0, 90), -1])
+        btc_price = rng.uniform(1_000, 1_000_000)
+        yield amount, currency, profit, btc_price
+
+
+def test_quote_properties():
+    for amount, currency, profit, btc_price in _random_cases():
+        quote = price_withdraw(amount, currency, profit, btc_price)
+        assert quote.price_msat == quote.payout_msat + quote.fee_msat
+        assert quote.payout_msat % 1000 == 0
+        assert 0 <= quote.payout_msat <= quote.price_msat
+        # the margin has 0.01% steps, rounding the payout down to sats costs
+        # the customer below one sat
+        margin = quote.price_msat * max(round(profit * 100), 0) / 10_000
+        assert quote.fee_msat < margin + 1000 + 1
+        if currency == "sat":
+            assert quote.price_msat == amount * 1000
+
+
+def test_quote_is_monotonic():
+    for _, currency, profit, btc_price in _random_cases(200):
+        payouts = [
+            price_withdraw(amount, currency, profit, btc_price).payout_msat
+            for amount in range(0, 5000, 7)
+        ]
+        assert payouts == sorted(payouts)
+
+
+def test_quote_without_rate_fails():
+    with pytest.raises(ValueError):
+        price_withdraw(1000, "USD", 2, None)
+
+
+@pytest.mark.asyncio
+async def test_quote_uses_one_rate_lookup(monkeypatch):
+    calls = []
+
+    async def _rate(currency: str) -> tuple[float, float]:
+        calls.append(currency)
+        return 2000.0, 50_000.0
+
+    monkeypatch.setattr(exchange_rates, "get_fiat_rate_and_price_satoshis", _rate)
+    fossa = Fossa(
+        id="fossa",
+        key="key",
+        title="test",
+        wallet="wallet",
+        profit=2,
+        currency="USD",
+        boltz=False,
+    )
+    quote = await quote_withdraw(fossa, LnurlDecrypted(pin=1, amount=1000))
+    # 10 USD at 50k USD per BTC
+    assert quote.price_msat == 20_000_000
+    assert quote.payout_sat == 19_600
+    assert quote.fee_msat == 400_000
+    assert calls == ["USD"]
+
+    fossa.currency = "sat"
+    await quote_withdraw(fossa, LnurlDecrypted(pin=1, amount=1000))
+    assert calls == ["USD"]
+
+
+@pytest.mark.asyncio
+async def test_quote_records_one_rate_snapshot_per_minute(monkeypatch):
+    snapshots = []
+
+    async def _rate(currency: str) -> tuple[float, float]:
+        return 2000.0, 50_000.0
+
+    async def _snapshot(currency: str, minute: int, price_cents: int) -> int:
+        snapshots.append((currency, price_cents))
+        return len(snapshots)
+
+    monkeypatch.setattr(exchange_rates, "get_fiat_rate_and_price_satoshis", _rate)
+    monkeypatch.setattr(pricing, "get_or_create_rate_snapshot", _snapshot)
+    monkeypatch.setattr(pricing, "_snapshots", {})
+    fossa = Fossa(
+        id="fossa",
+        key="key",
+        title="test",
+        wallet="wallet",
+        profit=2,
+        currency="EUR",
+        boltz=False,
+    )
+    for amount in (1000, 2000):
+        quote = await quote_withdraw(fossa, LnurlDecrypted(pin=1, amount=amount))
+        assert quote.rate_snapshot_id == 1
+    assert snapshots == [("EUR", 5_000_000)]
+
+    fossa.currency = "sat"
+    quote = await quote_withdraw(fossa, LnurlDecrypted(pin=1, amount=1000))
+    assert quote.rate_snapshot_id is None
@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+from fastapi.encoders import jsonable_encoder
+
+from ..models import Fossa, FossaPayment, FossaPaymentRow, FossaRow
+
+
+def test_payment_row_matches_model():
+    timestamp = datetime(2024, 1, 2, 3, 4, 5, 600000, tzinfo=timezone.utc)
+    model = FossaPayment(
+        id="payload",
+        fossa_id="fossa",
+        payment_hash="hash",
+        pin=1234,
+        sats=1000,
+        amount=980.0,
+        timestamp=timestamp,
+        updated_at=1,
+    )
+    row = FossaPaymentRow({**model.dict(), "timestamp": timestamp.timestamp()})
+    assert row.dict() == jsonable_encoder(model)
+
+
+def test_fossa_row_matches_model():
+    model = Fossa(
+        id="fossa",
+        key="key",
+        title="test",
+        wallet="wallet",
+        profit=1.5,
+        currency="EUR",
+        boltz=True,
+    )
+    # sqlite returns booleans as integers and extra columns like `timestamp`
+    row = FossaRow({**model.dict(), "boltz": 1, "timestamp": 0})
+    assert row.dict() == jsonable_encoder(model)
+
+
+def test_rows_declare_the_model_fields():
+    for row_class, model in ((FossaRow, Fossa), (FossaPaymentRow, FossaPayment)):
+        assert row_class.__slots__ == tuple(model.__fields__)
+        assert tuple(row_class.__annotations__) == row_class.__slots__
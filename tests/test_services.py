@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import pytest_asyncio
+from lnbits.core.models import Payment
+from lnbits.db import SQLITE, Database
+from lnbits.settings import settings
+
+from .. import crud, migrations, services
+from ..journal import PaymentJournal
+from ..models import CreateFossa, Fossa, FossaPayment
+from ..services import (
+    SYNC_OVERLAP_MS,
+    TOMBSTONE_RETENTION_MS,
+    get_changes,
+    reconcile_pending_payments,
+)
+
+SCANNED = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+def _fossa_payment(fossa_payment_id: str, amount: int = 1000) -> FossaPayment:
+    return FossaPayment(
+        id=fossa_payment_id,
+        fossa_id="fossa",
+        payment_hash="pending",
+        pin=1234,
+        sats=amount,
+        amount=amount,
+        timestamp=SCANNED,
+    )
+
+
+def _core_payment(
+    payment_hash: str, status: str, extra: dict, amount: int = 1000
+) -> Payment:
+    return Payment(
+        checking_id=payment_hash,
+        payment_hash=payment_hash,
+        wallet_id="wallet",
+        amount=-amount * 1000,
+        fee=0,
+        bolt11="lnbc",
+        status=status,
+        time=SCANNED + timedelta(seconds=5),
+        extra=extra,
+    )
+
+
+@pytest.fixture
+def reconcile_db(monkeypatch):
+    """Pending payments and core payments of the reconciler, in memory."""
+    db: dict = {
+        "pending": [],
+        "core": [],
+        "recorded": set(),
+        "settled": {},
+        "released": [],
+    }
+
+    async def _pending(older_than, fossa_ids=None):
+        return db["pending"]
+
+    async def _core(since):
+        return db["core"]
+
+    async def _recorded(payment_hashes):
+        return db["recorded"] & set(payment_hashes)
+
+    async def _fossa(fossa_id):
+        return Fossa(
+            id=fossa_id,
+            key="key",
+            title="test",
+            wallet="wallet",
+            profit=0,
+            currency="sat",
+            boltz=False,
+        )
+
+    async def _settle(settled):
+        db["settled"].update(settled)
+
+    async def _release(fossa_payment_ids):
+        db["released"].extend(fossa_payment_ids)
+
+    monkeypatch.setattr(services, "get_pending_fossa_payments", _pending)
+    monkeypatch.setattr(services, "get_core_fossa_payments", _core)
+    monkeypatch.setattr(services, "get_recorded_payment_hashes", _recorded)
+    monkeypatch.setattr(services, "get_fossa", _fossa)
+    monkeypatch.setattr(services, "settle_fossa_payments", _settle)
+    monkeypatch.setattr(services, "release_fossa_payments", _release)
+    monkeypatch.setattr(services, "payment_journal", PaymentJournal())
+    return db
+
+
+@pytest.mark.asyncio
+async def test_reconcile_settles_releases_and_waits(reconcile_db):
+    reconcile_db["pending"] = [
+        _fossa_payment("paid"),
+        _fossa_payment("paying"),
+        _fossa_payment("failed"),
+        _fossa_payment("never_paid"),
+    ]
+    reconcile_db["core"] = [
+        _core_payment("hash1", "failed", {"tag": "fossa", "id": "paid"}),
+        _core_payment("hash2", "success", {"tag": "fossa", "id": "paid"}),
+        _core_payment("hash3", "pending", {"tag": "fossa", "id": "paying"}),
+        _core_payment("hash4", "failed", {"tag": "fossa", "id": "failed"}),
+    ]
+    report = await reconcile_pending_payments(0)
+    assert report.settled == ["paid"]
+    assert report.in_flight == ["paying"]
+    assert report.released == ["failed", "never_paid"]
+    assert report.unmatched == []
+    assert reconcile_db["settled"] == {"paid": "hash2"}
+    assert reconcile_db["released"] == ["failed", "never_paid"]
+
+
+@pytest.mark.asyncio
+async def test_reconcile_matches_untagged_payments(reconcile_db):
+    # paid by the lnurl callback before it tagged payments with the id
+    reconcile_db["pending"] = [_fossa_payment("paid"), _fossa_payment("other", 500)]
+    reconcile_db["core"] = [_core_payment("hash1", "success", {"tag": "fossa"})]
+    report = await reconcile_pending_payments(0)
+    assert report.settled == ["paid"]
+    # the untagged payment is taken, nothing else could belong to `other`
+    assert report.released == ["other"]
+
+    # an untagged payment that fits none of them keeps both pending
+    reconcile_db["settled"].clear()
+    reconcile_db["released"].clear()
+    reconcile_db["core"] = [
+        _core_payment("hash1", "success", {"tag": "fossa"}, 700),
+        _core_payment("hash2", "success", {"tag": "fossa"}, 1000),
+    ]
+    reconcile_db["recorded"] = {"hash2"}
+    report = await reconcile_pending_payments(0)
+    assert report.unmatched == ["paid", "other"]
+    assert report.settled == report.released == []
+    assert reconcile_db["released"] == []
+
+
+@pytest_asyncio.fixture
+async def sync_db(tmp_path, monkeypatch):
+    """A migrated sqlite database and a clock for the sync cursors."""
+    monkeypatch.setattr(settings, "lnbits_data_folder", str(tmp_path))
+    db = Database("ext_fossa")
+    if db.type != SQLITE:
+        pytest.skip("runs on a temporary sqlite database")
+    async with db.connect() as conn:
+        for name in sorted(n for n in dir(migrations) if n.startswith("m0")):
+            await getattr(migrations, name)(conn)
+    clock = {"now": 1_700_000_000_000}
+    monkeypatch.setattr(crud, "db", db)
+    monkeypatch.setattr(crud, "now_ms", lambda: clock["now"])
+    monkeypatch.setattr(services, "now_ms", lambda: clock["now"])
+    yield clock
+    await db.engine.dispose()
+
+
+@pytest.mark.asyncio
+async def test_get_changes_overlap_reset_and_tombstones(sync_db):
+    start = sync_db["now"]
+    fossa = await crud.create_fossa(
+        CreateFossa(title="test", wallet="wallet", currency="sat", profit=0)
+    )
+    for fossa_payment_id, offset in (("first", 8000), ("second", 9000)):
+        sync_db["now"] = start + offset
+        await crud.create_fossa_payment_if_new(
+            FossaPayment(
+                id=fossa_payment_id, fossa_id=fossa.id, pin=1, sats=1, amount=1
+            )
+        )
+
+    changes = await get_changes(["wallet"])
+    assert [f.id for f in changes.fossas] == [fossa.id]
+    assert [p.id for p in changes.fossa_payments] == ["first", "second"]
+    assert changes.cursor == start + 9000
+
+    # rows changed shortly before the cursor are sent again
+    assert start + 9000 - SYNC_OVERLAP_MS < start + 8000
+    changes = await get_changes(["wallet"], changes.cursor)
+    assert changes.fossas == []
+    assert [p.id for p in changes.fossa_payments] == ["first", "second"]
+    assert changes.cursor == start + 9000
+
+    # deleting a device deletes its payments from the synced state too
+    sync_db["now"] = start + 20000
+    await crud.delete_fossa(fossa.id)
+    changes = await get_changes(["wallet"], changes.cursor)
+    assert changes.fossas == changes.fossa_payments == []
+    assert sorted((t.kind, t.id) for t in changes.deleted) == [
+        ("fossa", fossa.id),
+        ("fossa_payment", "first"),
+        ("fossa_payment", "second"),
+    ]
+    assert changes.cursor == start + 20000
+
+    # tombstones of a cursor this old may be gone, start over instead
+    sync_db["now"] = start + 20000 + TOMBSTONE_RETENTION_MS + 1
+    changes = await get_changes(["wallet"], changes.cursor)
+    assert changes.reset
+    assert changes.deleted == []
+    assert changes.cursor == 0
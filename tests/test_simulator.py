@@ -0,0 +1,20 @@
+from ..helpers import aes_decrypt_payload, parse_lnurl_payload
+from ..simulator import SimulatedFossa, percentile
+
+
+def test_voucher_is_readable_by_helpers():
+    fossa = SimulatedFossa(id="abcde", key="0123456789abcdef", currency="USD")
+    lnurl = fossa.voucher("http://localhost:5000", 1234, 2000)
+    lnurl_payload = parse_lnurl_payload(lnurl)
+    assert lnurl_payload.fossa_id == "abcde"
+    assert len(lnurl_payload.payload) % 22 == 0
+    decrypted = aes_decrypt_payload(lnurl_payload.payload, fossa.key)
+    assert decrypted.pin == 1234
+    assert decrypted.amount == 2000
+
+
+def test_percentile():
+    values = [float(v) for v in range(1, 101)]
+    assert percentile(values, 0.5) == 50
+    assert percentile(values, 0.99) == 99
+    assert percentile([], 0.5) == 0
@@ -0,0 +1,27 @@
+import pytest
+
+from ..tracing import span, start_trace, traced
+
+
+@traced("double")
+async def _double(value: int) -> int:
+    return value * 2
+
+
+def test_span_outside_trace_is_noop():
+    with span("noop"):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_trace_records_nested_spans():
+    with start_trace("test") as trace:
+        with span("outer"):
+            assert await _double(2) == 4
+        with pytest.raises(ValueError), span("failing"):
+            raise ValueError()
+
+    names = [(s[0], s[1]) for s in trace.spans]
+    assert names == [("double", 1), ("outer", 0), ("failing", 0)]
+    assert trace.spans[-1][4] == "ValueError"
+    assert trace.to_dict(0.5)["duration_ms"] == 500
@@ -0,0 +1,142 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi import BackgroundTasks, HTTPException
+
+from .. import views_api_atm
+from ..journal import PaymentJournal
+from ..limits import WithdrawLimits
+from ..models import (
+    Fossa,
+    FossaPayment,
+    FossaWithdrawJob,
+    FossaWithdrawOutcome,
+    LnurlDecrypted,
+    LnurlPayload,
+    WithdrawStatus,
+)
+from ..views_api_atm import LIGHTNING_SUCCESS, get_fossa_payment_lightning
+
+INVOICE = "lnbc10u1invoice"
+
+
+@pytest.fixture
+def atm_db(monkeypatch):
+    """Payment and stored outcome of one voucher, in memory."""
+    db: dict = {
+        "payment": FossaPayment(
+            id="payload", fossa_id="fossa", pin=1234, sats=1000, amount=1000
+        ),
+        "outcome": None,
+        "claims": 0,
+    }
+
+    async def _outcome(fossa_payment_id):
+        return db["outcome"]
+
+    async def _set_outcome(outcome):
+        db["outcome"] = outcome
+
+    async def _payment(fossa_payment_id):
+        return db["payment"]
+
+    async def _claim(fossa_payment_id, claim="pending"):
+        db["claims"] += 1
+        if db["payment"].payment_hash:
+            return False
+        db["payment"].payment_hash = claim
+        return True
+
+    async def _fossa(fossa_id):
+        return Fossa(
+            id=fossa_id,
+            key="key",
+            title="test",
+            wallet="wallet",
+            profit=0,
+            currency="sat",
+            boltz=False,
+        )
+
+    async def _wallet(wallet_id):
+        return SimpleNamespace(balance=1_000_000)
+
+    async def _quote(fossa, decrypted, payload):
+        return SimpleNamespace(payout_sat=1000, price_sat=1000, rate_snapshot_id=None)
+
+    limits = WithdrawLimits()
+    limits.loaded = True
+    monkeypatch.setattr(
+        views_api_atm,
+        "parse_lnurl_payload",
+        lambda lnurl: LnurlPayload(fossa_id="fossa", payload="payload"),
+    )
+    monkeypatch.setattr(
+        views_api_atm,
+        "aes_decrypt_payload",
+        lambda payload, key: LnurlDecrypted(pin=1234, amount=1000),
+    )
+    monkeypatch.setattr(views_api_atm, "get_withdraw_outcome", _outcome)
+    monkeypatch.setattr(views_api_atm, "set_withdraw_outcome", _set_outcome)
+    monkeypatch.setattr(views_api_atm, "get_fossa_payment", _payment)
+    monkeypatch.setattr(views_api_atm, "claim_fossa_payment", _claim)
+    monkeypatch.setattr(views_api_atm, "get_fossa", _fossa)
+    monkeypatch.setattr(views_api_atm, "get_wallet", _wallet)
+    monkeypatch.setattr(views_api_atm, "quote_withdraw", _quote)
+    monkeypatch.setattr(views_api_atm, "withdraw_limits", limits)
+    monkeypatch.setattr(views_api_atm, "payment_journal", PaymentJournal())
+    return db
+
+
+def _outcome(payment_hash: str, destination: str = f"ln:{INVOICE}", response=""):
+    return FossaWithdrawOutcome(
+        id="payload",
+        destination=destination,
+        payment_hash=payment_hash,
+        response=response,
+    )
+
+
+@pytest.mark.asyncio
+async def test_retry_while_paying_returns_the_job(atm_db):
+    atm_db["payment"].payment_hash = "pending"
+    atm_db["outcome"] = _outcome("pending")
+    tasks = BackgroundTasks()
+    job = await get_fossa_payment_lightning("lnurl", INVOICE, tasks, background=True)
+    assert job == FossaWithdrawJob(id="payload", status=WithdrawStatus.PAYING)
+    assert atm_db["claims"] == 0
+    assert tasks.tasks == []
+
+
+@pytest.mark.asyncio
+async def test_retry_after_release_withdraws_again(atm_db):
+    # the marker of a released withdraw is stale
+    atm_db["outcome"] = _outcome("pending")
+    tasks = BackgroundTasks()
+    job = await get_fossa_payment_lightning("lnurl", INVOICE, tasks, background=True)
+    assert job == FossaWithdrawJob(id="payload", status=WithdrawStatus.PENDING)
+    assert atm_db["claims"] == 1
+    assert len(tasks.tasks) == 1
+    assert atm_db["outcome"].in_flight
+
+
+@pytest.mark.asyncio
+async def test_replay_of_a_successful_withdraw(atm_db):
+    atm_db["payment"].payment_hash = "hash"
+    atm_db["outcome"] = _outcome("hash", response=LIGHTNING_SUCCESS.json())
+    tasks = BackgroundTasks()
+    assert (
+        await get_fossa_payment_lightning("lnurl", INVOICE, tasks, background=False)
+        == LIGHTNING_SUCCESS
+    )
+    job = await get_fossa_payment_lightning("lnurl", INVOICE, tasks, background=True)
+    assert job == FossaWithdrawJob(id="payload", status=WithdrawStatus.PAID)
+    assert atm_db["claims"] == 0
+
+    # another destination is a new withdraw of a claimed voucher
+    with pytest.raises(HTTPException, match="Payment already claimed"):
+        await get_fossa_payment_lightning(
+            "lnurl", "lnbc10u1other", tasks, background=True
+        )
+    assert atm_db["claims"] == 1
+    assert tasks.tasks == []
@@ -0,0 +1,131 @@
+import inspect
+import json
+import random
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+from typing import Any, TypeVar
+
+from loguru import logger
+
+# traces slower than this are always logged
+TRACE_SLOW_THRESHOLD_MS = 1000
+# share of all other traces that is logged, 0 disables sampling
+TRACE_SAMPLE_RATE = 0.0
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Trace:
+    __slots__ = ("depth", "finished", "name", "spans", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = perf_counter()
+        self.depth = 0
+        self.finished = False
+        self.spans: list[tuple[str, int, float, float, str | None]] = []
+
+    def to_dict(self, duration: float) -> dict:
+        return {
+            "trace": self.name,
+            "duration_ms": round(duration * 1000, 3),
+            "spans": [
+                {
+                    "name": name,
+                    "depth": depth,
+                    "start_ms": round(start * 1000, 3),
+                    "duration_ms": round(span_duration * 1000, 3),
+                    **({"error": error} if error else {}),
+                }
+                for name, depth, start, span_duration, error in self.spans
+            ],
+        }
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("fossa_trace", default=None)
+
+
+def _should_log(duration: float) -> bool:
+    if duration * 1000 >= TRACE_SLOW_THRESHOLD_MS:
+        return True
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+
+@contextmanager
+def start_trace(name: str) -> Iterator[Trace]:
+    """
+    Root of a trace, spans opened in the same context are recorded on it.
+    The trace is only logged if it is slow or sampled.
+    """
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+        trace.finished = True
+        duration = perf_counter() - trace.start
+        if _should_log(duration):
+            logger.info(f"Fossa trace: {json.dumps(trace.to_dict(duration))}")
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """Time a stage of the current trace, a no-op outside of a trace."""
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        yield
+        return
+    start = perf_counter()
+    depth = trace.depth
+    trace.depth += 1
+    error = None
+    try:
+        yield
+    except BaseException as exc:
+        error = type(exc).__name__
+        raise
+    finally:
+        trace.depth = depth
+        trace.spans.append(
+            (name, depth, start - trace.start, perf_counter() - start, error)
+        )
+
+
+def _wrap(func: F, name: str, context: Callable[[str], Any]) -> F:
+    if inspect.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with context(name):
+                return await func(*args, **kwargs)
+
+        return async_wrapper  # type: ignore
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with context(name):
+            return func(*args, **kwargs)
+
+    return wrapper  # type: ignore
+
+
+def traced(name: str | None = None) -> Callable[[F], F]:
+    """Decorator, record calls of a sync or async function as a span."""
+
+    def decorator(func: F) -> F:
+        return _wrap(func, name or func.__name__, span)
+
+    return decorator
+
+
+def trace_request(name: str) -> Callable[[F], F]:
+    """Decorator, start a new trace for every call of a handler."""
+
+    def decorator(func: F) -> F:
+        return _wrap(func, name, start_trace)
+
+    return decorator
@@ -1,9 +1,11 @@
-from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from functools import lru_cache
+from hashlib import sha256
 from http import HTTPStatus
-from math import ceil
+from pathlib import Path
 
 from fastapi import APIRouter, Depends, HTTPException, Request
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from lnbits.core.crud import (
     get_installed_extensions,
     get_wallet,
@@ -11,21 +13,106 @@ from lnbits.core.crud import (
 from lnbits.core.models import User
 from lnbits.decorators import check_user_exists
 from lnbits.helpers import template_renderer
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
 from loguru import logger
 
+from .coordination import on_change
 from .crud import (
     get_fossa,
     get_fossa_payment,
-    update_fossa_payment,
 )
-from .helpers import aes_decrypt_payload, parse_lnurl_payload
+from .helpers import aes_decrypt_payload, lnurl_payload_url, parse_lnurl_payload
+from .pricing import quote_withdraw
+from .tracing import trace_request
 
 fossa_generic_router = APIRouter()
 
+RECEIPT_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# fingerprinted assets never change under their url
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+STATIC_DIR = Path(Path(__file__).parent, "static").resolve()
+# rendered receipts are ~300kB, only keep the most recent bodies in memory
+RECEIPT_BODY_CACHE_SIZE = 64
+RECEIPT_ETAG_CACHE_SIZE = 10000
+
+# receipts of settled payments never change, keyed by base url and payment id as
+# the body embeds absolute urls -> etag / rendered body
+_receipt_etags: OrderedDict[str, str] = OrderedDict()
+_receipt_bodies: OrderedDict[str, bytes] = OrderedDict()
+
+
+def _clear_receipt_cache() -> None:
+    _receipt_etags.clear()
+    _receipt_bodies.clear()
+
+
+on_change("fossa", _clear_receipt_cache)
+on_change("fossa_payment", _clear_receipt_cache)
+
+
+def _lru_set(cache: OrderedDict, key: str, value, size: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > size:
+        cache.popitem(last=False)
+
+
+@lru_cache
+def _static_hash(path: str) -> str:
+    content = Path(STATIC_DIR, path).read_bytes()
+    return sha256(content).hexdigest()[:16]
+
+
+def fossa_static_url_for(path: str) -> str:
+    """
+    Url of an extension asset, fingerprinted with its content hash and served
+    with a long lived Cache-Control by `static_asset`.
+    """
+    return f"/fossa/assets/{_static_hash(path)}/{path}"
+
 
 def fossa_renderer():
-    return template_renderer(["fossa/templates"])
+    renderer = template_renderer(["fossa/templates"])
+    renderer.env.globals["fossa_static_url_for"] = fossa_static_url_for
+    return renderer
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in tags or "*" in tags
+
+
+def _receipt_key(request: Request, payment_id: str) -> str:
+    return f"{request.base_url}{payment_id}"
+
+
+def _cached_receipt_response(request: Request, payment_id: str) -> Response | None:
+    key = _receipt_key(request, payment_id)
+    etag = _receipt_etags.get(key)
+    if not etag:
+        return None
+    headers = {"ETag": etag, "Cache-Control": RECEIPT_CACHE_CONTROL}
+    if _etag_matches(request, etag):
+        return Response(status_code=HTTPStatus.NOT_MODIFIED, headers=headers)
+    body = _receipt_bodies.get(key)
+    if body is None:
+        return None
+    _receipt_bodies.move_to_end(key)
+    return HTMLResponse(body, headers=headers)
+
+
+@fossa_generic_router.get("/assets/{version}/{path:path}")
+async def static_asset(version: str, path: str) -> FileResponse:
+    asset = Path(STATIC_DIR, path).resolve()
+    if not asset.is_relative_to(STATIC_DIR) or not asset.is_file():
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Not found.")
+    # an outdated version gets the current file, but it must not stick
+    cache_control = (
+        STATIC_CACHE_CONTROL if version == _static_hash(path) else "no-cache"
+    )
+    return FileResponse(asset, headers={"Cache-Control": cache_control})
 
 
 @fossa_generic_router.get("/", response_class=HTMLResponse)
@@ -37,6 +124,7 @@ async def index(request: Request, user: User = Depends(check_user_exists)):
 
 
 @fossa_generic_router.get("/atm", response_class=HTMLResponse)
+@trace_request("fossa.atm_page")
 async def atmpage(request: Request, lightning: str):
 
     lnurl_payload = parse_lnurl_payload(lightning)
@@ -68,29 +156,19 @@ async def atmpage(request: Request, lightning: str):
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND, detail="Invalid payload.."
         ) from e
-    price_sat = (
-        await fiat_amount_as_satoshis(decrypted.amount / 100, fossa.currency)
-        if fossa.currency != "sat"
-        else ceil(float(decrypted.amount))
-    )
-    if price_sat is None:
+    try:
+        quote = await quote_withdraw(fossa, decrypted, lnurl_payload.payload)
+    except ValueError as e:
         raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND, detail="Price fetch error."
-        )
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Price fetch error. {e}",
+        ) from e
 
-    amount_sats = await fossa.amount_to_sats(decrypted.amount)
+    amount_sats = quote.payout_sat
 
-    # get to determine if the payload has been used
+    # get to determine if the payload has been used,
+    # pending swaps are resolved by the swap tracker
     payment = await get_fossa_payment(lnurl_payload.payload)
-    ten_minutes_ago = datetime.now(timezone.utc) - timedelta(minutes=10)
-    if (
-        payment
-        and payment.payment_hash
-        and payment.payment_hash.startswith("pending_swap_")
-        and payment.timestamp < ten_minutes_ago
-    ):
-        payment.payment_hash = None
-        payment = await update_fossa_payment(payment)
 
     return fossa_renderer().TemplateResponse(
         "fossa/atm.html",
@@ -99,6 +177,7 @@ async def atmpage(request: Request, lightning: str):
             "lnurl": lightning,
             "amount_sat": amount_sats,
             "fossa_id": fossa.id,
+            "payment_id": lnurl_payload.payload,
             "boltz": fossa.boltz,
             "used": bool(
                 payment
@@ -112,6 +191,10 @@ async def atmpage(request: Request, lightning: str):
 
 @fossa_generic_router.get("/print/{payment_id}", response_class=HTMLResponse)
 async def print_receipt(request: Request, payment_id):
+    cached = _cached_receipt_response(request, payment_id)
+    if cached:
+        return cached
+
     fossa_payment = await get_fossa_payment(payment_id)
     if not fossa_payment:
         raise HTTPException(
@@ -123,7 +206,7 @@ async def print_receipt(request: Request, payment_id):
             status_code=HTTPStatus.NOT_FOUND, detail="Unable to find fossa."
         )
 
-    return fossa_renderer().TemplateResponse(
+    response = fossa_renderer().TemplateResponse(
         "fossa/atm_receipt.html",
         {
             "request": request,
@@ -132,6 +215,18 @@ async def print_receipt(request: Request, payment_id):
             "title": fossa.title,
             "payment_hash": bool(fossa_payment.payment_hash),
             "sats": fossa_payment.sats,
-            "payload": fossa_payment.payload,
+            "payload": lnurl_payload_url(request, fossa.id, fossa_payment.id),
         },
     )
+    # receipts of unsettled payments still change, "pending" or "pending_swap_..."
+    payment_hash = fossa_payment.payment_hash
+    if not payment_hash or payment_hash.startswith("pending"):
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    body = bytes(response.body)
+    etag = f'"{sha256(body).hexdigest()}"'
+    key = _receipt_key(request, payment_id)
+    _lru_set(_receipt_etags, key, etag, RECEIPT_ETAG_CACHE_SIZE)
+    _lru_set(_receipt_bodies, key, body, RECEIPT_BODY_CACHE_SIZE)
+    return _cached_receipt_response(request, payment_id)
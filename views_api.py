@@ -1,6 +1,8 @@
+from datetime import datetime, timezone
 from http import HTTPStatus
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import JSONResponse
 from lnbits.core.crud import get_user, get_wallet
 from lnbits.core.models import WalletTypeInfo
 from lnbits.decorators import (
@@ -8,25 +10,65 @@ from lnbits.decorators import (
     require_invoice_key,
 )
 
+from .coordination import notify_change
 from .crud import (
     create_fossa,
     delete_fossa,
+    get_fiat_report,
     get_fossa,
     get_fossas,
     update_fossa,
 )
-from .models import CreateFossa, Fossa
+from .helpers import with_payload_urls
+from .models import CreateFossa, Fossa, FossaChanges, FossaFiatReport
+from .services import get_changes
 
 fossa_api_router = APIRouter()
 
 
-@fossa_api_router.get("/api/v1/fossa")
+@fossa_api_router.get("/api/v1/fossa", response_model=list[Fossa])
 async def api_fossas_retrieve(
     key_info: WalletTypeInfo = Depends(require_invoice_key),
-) -> list[Fossa]:
+) -> JSONResponse:
     user = await get_user(key_info.wallet.user)
     assert user, "Fossa cannot retrieve user"
-    return await get_fossas(user.wallet_ids)
+    # rows are serialized directly, without a model per row
+    fossas = await get_fossas(user.wallet_ids)
+    return JSONResponse([fossa.dict() for fossa in fossas])
+
+
+@fossa_api_router.get("/api/v1/changes")
+async def api_changes_retrieve(
+    request: Request,
+    since: int = Query(0, description="`cursor` of the previous call"),
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> FossaChanges:
+    """Fossas and atm payments changed since the cursor, for polling clients."""
+    user = await get_user(wallet.wallet.user)
+    if not user:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="User does not exist"
+        )
+    changes = await get_changes(user.wallet_ids, since)
+    with_payload_urls(request, changes.fossa_payments)
+    return changes
+
+
+@fossa_api_router.get("/api/v1/report/fiat")
+async def api_fiat_report(
+    since: int | None = Query(None, description="unix time in seconds"),
+    key_info: WalletTypeInfo = Depends(require_invoice_key),
+) -> list[FossaFiatReport]:
+    """Fiat value of paid withdraws per fossa, at the rates used to price them."""
+    user = await get_user(key_info.wallet.user)
+    if not user:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="User does not exist"
+        )
+    return await get_fiat_report(
+        user.wallet_ids,
+        datetime.fromtimestamp(since, timezone.utc) if since is not None else None,
+    )
 
 
 @fossa_api_router.get("/api/v1/fossa/{fossa_id}")
@@ -75,7 +117,9 @@ async def api_fossa_update(
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your fossa")
     for k, v in data.dict().items():
         setattr(fossa, k, v)
-    return await update_fossa(fossa)
+    fossa = await update_fossa(fossa)
+    await notify_change("fossa")
+    return fossa
 
 
 @fossa_api_router.delete("/api/v1/fossa/{fossa_id}")
@@ -97,3 +141,4 @@ async def api_fossa_delete(
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your fossa")
 
     await delete_fossa(fossa_id)
+    await notify_change("fossa")
@@ -1,43 +1,96 @@
-from datetime import datetime, timedelta, timezone
+import asyncio
+import json
 from http import HTTPStatus
-from math import ceil
+from time import time
 
 import bolt11
 import httpx
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import (
+    APIRouter,
+    BackgroundTasks,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+)
+from fastapi.responses import JSONResponse
 from lnbits.core.crud import get_user, get_wallet
 from lnbits.core.models import SimpleStatus, WalletTypeInfo
-from lnbits.core.services import pay_invoice
+from lnbits.core.services import pay_invoice, websocket_updater
 from lnbits.decorators import (
     check_user_extension_access,
     require_admin_key,
 )
 from lnbits.helpers import is_valid_email_address
 from lnbits.settings import settings
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
-from lnurl import LnurlPayActionResponse, LnurlPayResponse, url_decode
+from lnurl import LnurlPayActionResponse, LnurlPayResponse
 from lnurl import execute_pay_request as lnurl_execute_pay_request
 from lnurl import handle as lnurl_handle
+from loguru import logger
 
+from .breakers import (
+    BOLTZ_TIMEOUT_SECONDS,
+    LNURL_TIMEOUT_SECONDS,
+    CircuitOpenError,
+    boltz_breaker,
+    breaker_statuses,
+    lnurl_breaker,
+    upstream_failure,
+)
+from .coordination import notify_change
 from .crud import (
-    create_fossa_payment,
+    claim_fossa_payment,
+    create_fossa_payment_if_new,
+    create_fossa_swap,
     delete_atm_payment_link,
     get_fossa,
     get_fossa_payment,
     get_fossa_payments,
     get_fossas,
+    get_payment_events,
+    get_withdraw_outcome,
+    set_fossa_swap,
+    set_withdraw_outcome,
     update_fossa_payment,
 )
-from .helpers import aes_decrypt_payload, parse_lnurl_payload
-from .models import FossaPayment
+from .helpers import (
+    aes_decrypt_payload,
+    lnurl_host,
+    parse_lnurl_payload,
+    with_payload_urls,
+)
+from .journal import payment_journal
+from .limits import withdraw_limits
+from .models import (
+    CircuitStatus,
+    FossaPayment,
+    FossaSwap,
+    FossaWithdrawJob,
+    FossaWithdrawOutcome,
+    PaymentEvent,
+    PaymentEventType,
+    ReconcileReport,
+    WithdrawStatus,
+)
+from .pricing import quote_withdraw
+from .services import (
+    RECONCILE_MIN_AGE_FLOOR_SECONDS,
+    RECONCILE_MIN_AGE_SECONDS,
+    reconcile_pending_payments,
+)
+from .swaps import swap_backoff
+from .tracing import span, trace_request, traced
 
 fossa_api_atm_router = APIRouter()
 
+LIGHTNING_SUCCESS = SimpleStatus(success=True, message="Payment successful")
 
-@fossa_api_atm_router.get("/api/v1/atm")
+
+@fossa_api_atm_router.get("/api/v1/atm", response_model=list[FossaPayment])
 async def api_atm_payments_retrieve(
+    request: Request,
     wallet: WalletTypeInfo = Depends(require_admin_key),
-) -> list[FossaPayment]:
+) -> JSONResponse:
     user = await get_user(wallet.wallet.user)
     if not user:
         raise HTTPException(
@@ -47,21 +100,54 @@ async def api_atm_payments_retrieve(
     ids = []
     for fossa in fossas:
         ids.append(fossa.id)
-    fossa_payments = await get_fossa_payments(ids)
+    # pending swaps are resolved by the swap tracker
+    fossa_payments = with_payload_urls(request, await get_fossa_payments(ids))
+    # rows are serialized directly, without a model per row
+    return JSONResponse([fossa_payment.dict() for fossa_payment in fossa_payments])
 
-    # Loop through any attempting swaps and if they failed clear them after 10 minutes
-    ten_minutes_ago = datetime.now(timezone.utc) - timedelta(minutes=10)
-    for payment in fossa_payments:
-        if (
-            payment.payment_hash
-            and payment.payment_hash.startswith("pending_swap_")
-            and payment.timestamp < ten_minutes_ago
-        ):
-            payment.payment_hash = None
-            await update_fossa_payment(payment)
 
-    # get updated payments list
-    return await get_fossa_payments(ids)
+@fossa_api_atm_router.post("/api/v1/atm/reconcile")
+async def api_atm_payments_reconcile(
+    min_age: int = Query(RECONCILE_MIN_AGE_SECONDS, ge=RECONCILE_MIN_AGE_FLOOR_SECONDS),
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+) -> ReconcileReport:
+    """
+    Settle or release the user's payments claimed `min_age` seconds ago and still
+    pending.
+    """
+    user = await get_user(wallet.wallet.user)
+    if not user:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="User does not exist"
+        )
+    fossas = await get_fossas(user.wallet_ids)
+    return await reconcile_pending_payments(min_age, [fossa.id for fossa in fossas])
+
+
+@fossa_api_atm_router.get(
+    "/api/v1/atm/breakers", dependencies=[Depends(require_admin_key)]
+)
+async def api_atm_breakers() -> list[CircuitStatus]:
+    """State of the circuit breakers around boltz, lnurl hosts and rates."""
+    return breaker_statuses()
+
+
+@fossa_api_atm_router.get("/api/v1/atm/{atm_id}/events")
+async def api_atm_payment_events(
+    atm_id: str, wallet: WalletTypeInfo = Depends(require_admin_key)
+) -> list[PaymentEvent]:
+    """Journal of an atm payment, also kept after the payment was deleted."""
+    await payment_journal.flush()
+    events = await get_payment_events(atm_id)
+    if len(events) == 0:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="No events for this payment."
+        )
+    fossa = await get_fossa(events[0].fossa_id)
+    fetched_wallet = await get_wallet(fossa.wallet) if fossa else None
+    if not fetched_wallet or fetched_wallet.user != wallet.wallet.user:
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your fossa")
+    return events
 
 
 @fossa_api_atm_router.delete("/api/v1/atm/{atm_id}")
@@ -88,21 +174,45 @@ async def api_atm_payment_delete(
         raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail="Not your fossa")
 
     await delete_atm_payment_link(atm_id)
+    payment_journal.record(atm_id, fossa.id, PaymentEventType.DELETED)
+    await notify_change("fossa_payment")
 
 
+@traced()
 async def _validate_payment_request(pr: str, amount_msat: int) -> str:
     pr = pr.lower().strip()
     if pr.startswith("lnbc"):
         ln = pr
     elif pr.startswith("lnurl1") or is_valid_email_address(pr):
-        res = await lnurl_handle(pr)
-        if not isinstance(res, LnurlPayResponse):
-            raise HTTPException(
-                status_code=HTTPStatus.FORBIDDEN, detail="Not valid LNURL Pay response"
+        breaker = lnurl_breaker(lnurl_host(pr))
+        try:
+            res = await breaker.call(
+                lambda: lnurl_handle(pr, timeout=LNURL_TIMEOUT_SECONDS),
+                upstream_failure,
             )
-        res2 = await lnurl_execute_pay_request(
-            res, msat=amount_msat, user_agent=settings.user_agent
-        )
+            if not isinstance(res, LnurlPayResponse):
+                raise HTTPException(
+                    status_code=HTTPStatus.FORBIDDEN,
+                    detail="Not valid LNURL Pay response",
+                )
+            res2 = await breaker.call(
+                lambda: lnurl_execute_pay_request(
+                    res,
+                    msat=amount_msat,
+                    user_agent=settings.user_agent,
+                    timeout=LNURL_TIMEOUT_SECONDS,
+                ),
+                upstream_failure,
+            )
+        except CircuitOpenError as e:
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE, detail=str(e)
+            ) from e
+        except asyncio.TimeoutError as e:
+            raise HTTPException(
+                status_code=HTTPStatus.GATEWAY_TIMEOUT,
+                detail=f"{breaker.name} did not respond in time.",
+            ) from e
         if not isinstance(res2, LnurlPayActionResponse):
             raise HTTPException(
                 status_code=HTTPStatus.FORBIDDEN,
@@ -128,14 +238,112 @@ async def _validate_payment_request(pr: str, amount_msat: int) -> str:
     return ln
 
 
+async def _store_outcome(
+    fossa_payment: FossaPayment, destination: str, response: str = ""
+) -> None:
+    """
+    Remember a withdraw so retries get the same answer, call right after the
+    claim without `response` to mark it in flight.
+    """
+    try:
+        assert fossa_payment.payment_hash
+        await set_withdraw_outcome(
+            FossaWithdrawOutcome(
+                id=fossa_payment.id,
+                destination=destination,
+                payment_hash=fossa_payment.payment_hash,
+                response=response,
+            )
+        )
+    except Exception as exc:
+        # the withdraw itself succeeded, retries just take the long way
+        logger.warning(f"Fossa withdraw outcome {fossa_payment.id} not stored: {exc}")
+
+
+async def _still_in_flight(outcome: FossaWithdrawOutcome) -> bool:
+    """An in flight marker is stale once its payment was released again."""
+    fossa_payment = await get_fossa_payment(outcome.id)
+    return bool(
+        fossa_payment
+        and fossa_payment.payment_hash
+        and fossa_payment.payment_hash.startswith("pending")
+    )
+
+
+@trace_request("fossa.lightning_withdraw_job")
+async def _lightning_withdraw_job(
+    fossa_payment: FossaPayment,
+    wallet_id: str,
+    withdraw_request: str,
+    amount_sat: int,
+) -> None:
+    """
+    Resolve and pay a claimed withdraw outside of the request,
+    progress is pushed to the websocket of the payment id.
+    """
+    try:
+        await websocket_updater(fossa_payment.id, str(WithdrawStatus.RESOLVING))
+        ln = await _validate_payment_request(withdraw_request, amount_sat * 1000)
+        await websocket_updater(fossa_payment.id, str(WithdrawStatus.PAYING))
+        with span("pay_invoice"):
+            payment = await pay_invoice(
+                wallet_id=wallet_id,
+                payment_request=ln,
+                extra={"tag": "fossa", "id": fossa_payment.id},
+            )
+        fossa_payment.payment_hash = payment.payment_hash
+        await update_fossa_payment(fossa_payment)
+        payment_journal.record(
+            fossa_payment.id,
+            fossa_payment.fossa_id,
+            PaymentEventType.PAID,
+            payment.payment_hash,
+        )
+        await _store_outcome(
+            fossa_payment, f"ln:{withdraw_request}", LIGHTNING_SUCCESS.json()
+        )
+        await websocket_updater(fossa_payment.id, str(WithdrawStatus.PAID))
+    except Exception as exc:
+        logger.warning(f"Fossa withdraw {fossa_payment.id} failed: {exc}")
+        # unsuccessful payment, release fossa_payment
+        fossa_payment.payment_hash = None
+        await update_fossa_payment(fossa_payment)
+        payment_journal.record(
+            fossa_payment.id, fossa_payment.fossa_id, PaymentEventType.FAILED, str(exc)
+        )
+        withdraw_limits.release(fossa_payment.fossa_id, amount_sat)
+        await websocket_updater(fossa_payment.id, str(WithdrawStatus.FAILED))
+
+
 @fossa_api_atm_router.get("/api/v1/ln/{lnurl}/{withdraw_request}")
+@trace_request("fossa.lightning")
 async def get_fossa_payment_lightning(
-    lnurl: str, withdraw_request: str
-) -> SimpleStatus:
+    lnurl: str,
+    withdraw_request: str,
+    background_tasks: BackgroundTasks,
+    background: bool = Query(False),
+) -> SimpleStatus | FossaWithdrawJob:
     """
     Handle Lightning payments for atms via invoice, lnaddress, lnurlp (withdraw_request)
+    With `background=true` the payload is claimed and the request returns right away,
+    progress is sent over the websocket of the returned job id.
     """
     lnurl_payload = parse_lnurl_payload(lnurl)
+    destination = f"ln:{withdraw_request}"
+    # retries get the stored outcome, or the job status while the first request
+    # is still paying, before any upstream call
+    outcome = await get_withdraw_outcome(lnurl_payload.payload)
+    if outcome and outcome.destination == destination and outcome.in_flight:
+        if await _still_in_flight(outcome):
+            return FossaWithdrawJob(id=outcome.id, status=WithdrawStatus.PAYING)
+    elif outcome and outcome.destination == destination:
+        payment_journal.record(
+            outcome.id, lnurl_payload.fossa_id, PaymentEventType.REPLAYED, "ln"
+        )
+        if background:
+            return FossaWithdrawJob(id=outcome.id, status=WithdrawStatus.PAID)
+        return SimpleStatus.parse_raw(outcome.response)
+
     fossa = await get_fossa(lnurl_payload.fossa_id)
     if not fossa:
         raise HTTPException(
@@ -154,62 +362,96 @@ async def get_fossa_payment_lightning(
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail="Invalid payload."
         ) from e
-    amount_sat = await fossa.amount_to_sats(decrypted.amount)
+    try:
+        quote = await quote_withdraw(fossa, decrypted, lnurl_payload.payload)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Price fetch error. {e}",
+        ) from e
+    amount_sat = quote.payout_sat
 
     if wallet.balance < amount_sat:
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Not enough funds in wallet"
         )
-    price_sat = (
-        await fiat_amount_as_satoshis(float(decrypted.amount) / 100, fossa.currency)
-        if fossa.currency != "sat"
-        else ceil(float(decrypted.amount))
-    )
-    if price_sat is None:
-        raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND,
-            detail="Price fetch error.",
-        )
-
-    price_sat = int(price_sat * ((fossa.profit / 100) + 1))
-    ln = await _validate_payment_request(withdraw_request, amount_sat * 1000)
+    if not background:
+        ln = await _validate_payment_request(withdraw_request, amount_sat * 1000)
+    elif not withdraw_request.lower().startswith("lnbc"):
+        # fail fast instead of claiming for a lnurl host that is down
+        breaker = lnurl_breaker(lnurl_host(withdraw_request.lower().strip()))
+        if not breaker.available():
+            raise HTTPException(
+                status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+                detail=str(CircuitOpenError(breaker)),
+            )
+    limit_reason = await withdraw_limits.reserve(fossa, amount_sat)
+    if limit_reason:
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail=limit_reason)
     fossa_payment = await get_fossa_payment(lnurl_payload.payload)
+    claimed = False
     if not fossa_payment:
         fossa_payment = FossaPayment(
             id=lnurl_payload.payload,
             fossa_id=fossa.id,
-            sats=price_sat,
+            sats=quote.price_sat,
+            rate_snapshot_id=quote.rate_snapshot_id,
             amount=amount_sat,
             pin=decrypted.pin,
-            payload=str(url_decode(lnurl)),
             payment_hash="pending",
         )
-        await create_fossa_payment(fossa_payment)
-    else:
-        if fossa_payment.payment_hash:
-            raise HTTPException(
-                status_code=HTTPStatus.NOT_FOUND,
-                detail="Payment already claimed.",
-            )
-    try:
-        # set to pending and pay invoice in background to prevent double spending
-        fossa_payment.payment_hash = "pending"
-        await update_fossa_payment(fossa_payment)
-        payment = await pay_invoice(
-            wallet_id=fossa.wallet,
-            payment_request=ln,
-            extra={"tag": "fossa", "id": fossa_payment.id},
+        claimed = await create_fossa_payment_if_new(fossa_payment)
+    # claim atomically so concurrent requests and workers cannot both pay, this
+    # also covers a concurrent first request creating the row in the meantime
+    if not claimed and not await claim_fossa_payment(fossa_payment.id):
+        withdraw_limits.release(fossa.id, amount_sat)
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="Payment already claimed.",
+        )
+    fossa_payment.payment_hash = "pending"
+    limit_reason = await withdraw_limits.verify_claim(
+        fossa, fossa_payment.id, amount_sat
+    )
+    if limit_reason:
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail=limit_reason)
+    payment_journal.record(fossa_payment.id, fossa.id, PaymentEventType.CLAIMED, "ln")
+    await _store_outcome(fossa_payment, destination)
+
+    if background:
+        background_tasks.add_task(
+            _lightning_withdraw_job,
+            fossa_payment,
+            fossa.wallet,
+            withdraw_request,
+            amount_sat,
         )
+        return FossaWithdrawJob(id=fossa_payment.id, status=WithdrawStatus.PENDING)
+
+    try:
+        with span("pay_invoice"):
+            payment = await pay_invoice(
+                wallet_id=fossa.wallet,
+                payment_request=ln,
+                extra={"tag": "fossa", "id": fossa_payment.id},
+            )
         assert payment.payment_hash
         # successful payment, update fossa_payment
         fossa_payment.payment_hash = payment.payment_hash
         await update_fossa_payment(fossa_payment)
-
-        return SimpleStatus(success=True, message="Payment successful")
+        payment_journal.record(
+            fossa_payment.id, fossa.id, PaymentEventType.PAID, payment.payment_hash
+        )
+        await _store_outcome(fossa_payment, destination, LIGHTNING_SUCCESS.json())
+        return LIGHTNING_SUCCESS
     except Exception as err:
         # unsuccessful payment, release fossa_payment
         fossa_payment.payment_hash = None
         await update_fossa_payment(fossa_payment)
+        payment_journal.record(
+            fossa_payment.id, fossa.id, PaymentEventType.FAILED, str(err)
+        )
+        withdraw_limits.release(fossa.id, amount_sat)
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail="withdraw failed, try again later",
@@ -217,11 +459,25 @@ async def get_fossa_payment_lightning(
 
 
 @fossa_api_atm_router.get("/api/v1/boltz/{lnurl}/{onchain_liquid}/{address}")
+@trace_request("fossa.boltz")
 async def get_fossa_payment_boltz(lnurl: str, onchain_liquid: str, address: str):
     """
     Handle Boltz payments for atms.
     """
     lnurl_payload = parse_lnurl_payload(lnurl)
+    destination = f"boltz:{onchain_liquid}:{address}"
+    # retries of a started swap get the stored swap response, or the job status
+    # while the first request is still starting it
+    outcome = await get_withdraw_outcome(lnurl_payload.payload)
+    if outcome and outcome.destination == destination and outcome.in_flight:
+        if await _still_in_flight(outcome):
+            return FossaWithdrawJob(id=outcome.id, status=WithdrawStatus.PAYING)
+    elif outcome and outcome.destination == destination:
+        payment_journal.record(
+            outcome.id, lnurl_payload.fossa_id, PaymentEventType.REPLAYED, "boltz"
+        )
+        return json.loads(outcome.response)
+
     fossa = await get_fossa(lnurl_payload.fossa_id)
     if not fossa:
         raise HTTPException(
@@ -245,44 +501,60 @@ async def get_fossa_payment_boltz(lnurl: str, onchain_liquid: str, address: str)
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST, detail="Invalid payload."
         ) from e
-    price_sat = (
-        await fiat_amount_as_satoshis(float(decrypted.amount) / 100, fossa.currency)
-        if fossa.currency != "sat"
-        else ceil(float(decrypted.amount))
-    )
-    if price_sat is None:
+    try:
+        quote = await quote_withdraw(fossa, decrypted, lnurl_payload.payload)
+    except ValueError as e:
         raise HTTPException(
-            status_code=HTTPStatus.NOT_FOUND,
-            detail="Price fetch error",
-        )
-    price_sat = int(price_sat * ((fossa.profit / 100) + 1))
-    amount_sats = await fossa.amount_to_sats(decrypted.amount)
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=f"Price fetch error. {e}",
+        ) from e
+    amount_sats = quote.payout_sat
     if wallet.balance < amount_sats:
         raise HTTPException(
             status_code=HTTPStatus.FORBIDDEN, detail="Not enough funds in wallet"
         )
+    if not boltz_breaker.available():
+        raise HTTPException(
+            status_code=HTTPStatus.SERVICE_UNAVAILABLE,
+            detail=str(CircuitOpenError(boltz_breaker)),
+        )
+    limit_reason = await withdraw_limits.reserve(fossa, amount_sats)
+    if limit_reason:
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail=limit_reason)
     fossa_payment = await get_fossa_payment(lnurl_payload.payload)
+    claimed = False
     if not fossa_payment:
         fossa_payment = FossaPayment(
             id=lnurl_payload.payload,
             fossa_id=fossa.id,
-            sats=price_sat,
+            sats=quote.price_sat,
+            rate_snapshot_id=quote.rate_snapshot_id,
             amount=amount_sats,
             pin=decrypted.pin,
-            payload=str(url_decode(lnurl)),
+            payment_hash="pending",
         )
-        await create_fossa_payment(fossa_payment)
-    else:
-        if fossa_payment.payment_hash:
-            raise HTTPException(
-                status_code=HTTPStatus.NOT_FOUND,
-                detail="Payment already claimed.",
-            )
-    try:
-        # set to pending and pay invoice in background to prevent double spending
-        fossa_payment.payment_hash = "pending"
-        await update_fossa_payment(fossa_payment)
-        async with httpx.AsyncClient() as client:
+        claimed = await create_fossa_payment_if_new(fossa_payment)
+    # claim atomically so concurrent requests and workers cannot both pay, this
+    # also covers a concurrent first request creating the row in the meantime
+    if not claimed and not await claim_fossa_payment(fossa_payment.id):
+        withdraw_limits.release(fossa.id, amount_sats)
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND,
+            detail="Payment already claimed.",
+        )
+    fossa_payment.payment_hash = "pending"
+    limit_reason = await withdraw_limits.verify_claim(
+        fossa, fossa_payment.id, amount_sats
+    )
+    if limit_reason:
+        raise HTTPException(status_code=HTTPStatus.FORBIDDEN, detail=limit_reason)
+    payment_journal.record(
+        fossa_payment.id, fossa.id, PaymentEventType.CLAIMED, "boltz"
+    )
+    await _store_outcome(fossa_payment, destination)
+
+    async def _reverse_swap():
+        async with httpx.AsyncClient(timeout=BOLTZ_TIMEOUT_SECONDS) as client:
             response = await client.post(
                 url=f"http://{settings.host}:{settings.port}/boltz/api/v1/swap/reverse",
                 headers={"X-API-KEY": wallet.adminkey},
@@ -297,21 +569,91 @@ async def get_fossa_payment_boltz(lnurl: str, onchain_liquid: str, address: str)
                     "feerate_value": 0,
                 },
             )
+        # only server errors count against the breaker
+        if response.status_code >= 500:
             response.raise_for_status()
-            resp = response.json()
-            if not resp.get("preimage"):
-                raise HTTPException(
-                    status_code=HTTPStatus.NOT_FOUND,
-                    detail="Boltz payment could not be made, try again later",
-                )
-            fossa_payment.payment_hash = resp.get("id")
-            await update_fossa_payment(fossa_payment)
-            return resp
+        return response
 
+    try:
+        with span("boltz_swap"):
+            response = await boltz_breaker.call(_reverse_swap)
+        response.raise_for_status()
+        resp = response.json()
+        if not resp.get("preimage"):
+            raise HTTPException(
+                status_code=HTTPStatus.NOT_FOUND,
+                detail="Boltz payment could not be made, try again later",
+            )
+    except (asyncio.TimeoutError, httpx.TimeoutException) as err:
+        # boltz may still create and pay the swap, keep the voucher on hold,
+        # `pending_` keeps the reconciler and the claim away from it. the swap
+        # tracker looks the swap up by its address, then settles or releases it.
+        # a voucher released by an earlier lookup starts its lookup over
+        fossa_payment.payment_hash = "pending_boltz_timeout"
+        await update_fossa_payment(fossa_payment)
+        await set_fossa_swap(
+            FossaSwap(
+                id=f"lookup_{fossa_payment.id}",
+                fossa_payment_id=fossa_payment.id,
+                wallet=fossa.wallet,
+                status="swap.unknown",
+                next_check=int(time()) + swap_backoff(0),
+                onchain_address=address,
+            )
+        )
+        payment_journal.record(
+            fossa_payment.id,
+            fossa.id,
+            PaymentEventType.FAILED,
+            "boltz timeout, on hold",
+        )
+        raise HTTPException(
+            status_code=HTTPStatus.GATEWAY_TIMEOUT,
+            detail="Boltz did not respond in time, the voucher is on hold until "
+            "the swap is found or released.",
+        ) from err
     except Exception as err:
         fossa_payment.payment_hash = None
         await update_fossa_payment(fossa_payment)
+        payment_journal.record(
+            fossa_payment.id, fossa.id, PaymentEventType.FAILED, str(err)
+        )
+        withdraw_limits.release(fossa.id, amount_sats)
         raise HTTPException(
             status_code=HTTPStatus.NOT_FOUND,
             detail="Boltz payment could not be made, try again later",
         ) from err
+
+    # the swap is live from here on, never release the voucher again or a retry
+    # would start a second swap
+    try:
+        # `pending_swap_` keeps the reconciler away, then the swap tracker settles
+        # or releases the payment once boltz resolves it
+        fossa_payment.payment_hash = f"pending_swap_{resp['id']}"
+        await update_fossa_payment(fossa_payment)
+        await create_fossa_swap(
+            FossaSwap(
+                id=resp["id"],
+                fossa_payment_id=fossa_payment.id,
+                wallet=fossa.wallet,
+                next_check=int(time()) + swap_backoff(0),
+            )
+        )
+    except Exception as err:
+        logger.error(f"Fossa swap {resp['id']} of {fossa_payment.id} not saved: {err}")
+        payment_journal.record(
+            fossa_payment.id,
+            fossa.id,
+            PaymentEventType.SWAP_STARTED,
+            f"{resp['id']}, not saved: {err}",
+        )
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Boltz swap started but could not be saved, the voucher is on "
+            "hold. Please contact the operator.",
+        ) from err
+    payment_journal.record(
+        fossa_payment.id, fossa.id, PaymentEventType.SWAP_STARTED, resp["id"]
+    )
+    await _store_outcome(fossa_payment, destination, json.dumps(resp))
+    return resp
@@ -1,11 +1,9 @@
 from http import HTTPStatus
-from math import ceil
 
 from bolt11 import decode as bolt11_decode
 from fastapi import APIRouter, BackgroundTasks, Query, Request
 from lnbits.core.crud import get_wallet
 from lnbits.core.services import pay_invoice
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis
 from lnurl import (
     CallbackUrl,
     LnurlErrorResponse,
@@ -13,18 +11,22 @@ from lnurl import (
     LnurlWithdrawResponse,
     MilliSatoshi,
 )
-from lnurl import encode as lnurl_encode
 from loguru import logger
 from pydantic import parse_obj_as
 
 from .crud import (
-    create_fossa_payment,
+    claim_fossa_payment,
+    create_fossa_payment_if_new,
     get_fossa,
     get_fossa_payment,
     update_fossa_payment,
 )
 from .helpers import aes_decrypt_payload
-from .models import FossaPayment
+from .journal import payment_journal
+from .limits import withdraw_limits
+from .models import FossaPayment, PaymentEventType
+from .pricing import quote_withdraw
+from .tracing import span, trace_request
 
 fossa_lnurl_router = APIRouter(prefix="/api/v1/lnurl")
 
@@ -34,6 +36,7 @@ fossa_lnurl_router = APIRouter(prefix="/api/v1/lnurl")
     status_code=HTTPStatus.OK,
     name="fossa.lnurl_params",
 )
+@trace_request("fossa.lnurl_params")
 async def fossa_lnurl_params(
     request: Request,
     fossa_id: str,
@@ -50,31 +53,32 @@ async def fossa_lnurl_params(
         logger.debug(f"Error decrypting payload: {e}")
         return LnurlErrorResponse(reason="Invalid payload.")
 
-    price_sat = (
-        await fiat_amount_as_satoshis(float(decrypted.amount) / 100, fossa.currency)
-        if fossa.currency != "sat"
-        else ceil(float(decrypted.amount))
-    )
-    if price_sat is None:
-        return LnurlErrorResponse(reason="Price fetch error.")
+    try:
+        quote = await quote_withdraw(fossa, decrypted, payload)
+    except ValueError as e:
+        logger.warning(f"Fossa price fetch failed: {e}")
+        return LnurlErrorResponse(reason=f"Price fetch error. {e}")
 
-    amount_sats = await fossa.amount_to_sats(decrypted.amount)
-    url = request.url_for("fossa.lnurl_params", fossa_id=fossa.id)
-    lnurl_payload = str(lnurl_encode(str(url) + f"?p={payload}"))
+    amount_sats = quote.payout_sat
+    await withdraw_limits.ensure_loaded()
+    limit_reason = withdraw_limits.check(fossa, amount_sats)
+    if limit_reason:
+        return LnurlErrorResponse(reason=limit_reason)
     fossa_payment = await get_fossa_payment(payload)
     if not fossa_payment:
         fossa_payment = FossaPayment(
             id=payload,
             fossa_id=fossa.id,
-            sats=price_sat,
+            sats=quote.price_sat,
+            rate_snapshot_id=quote.rate_snapshot_id,
             amount=amount_sats,
             pin=decrypted.pin,
-            payload=lnurl_payload,
         )
-        await create_fossa_payment(fossa_payment)
-    else:
-        if fossa_payment.payment_hash:
-            return LnurlErrorResponse(reason="Payment already claimed.")
+        # a concurrent scan of the same voucher may have created it first
+        if await create_fossa_payment_if_new(fossa_payment):
+            payment_journal.record(fossa_payment.id, fossa.id, PaymentEventType.SCANNED)
+    elif fossa_payment.payment_hash:
+        return LnurlErrorResponse(reason="Payment already claimed.")
 
     url = request.url_for("fossa.lnurl_callback", payment_id=payload)
     callback = parse_obj_as(CallbackUrl, str(url))
@@ -95,6 +99,7 @@ async def fossa_lnurl_params(
     status_code=HTTPStatus.OK,
     name="fossa.lnurl_callback",
 )
+@trace_request("fossa.lnurl_callback")
 async def lnurl_callback(
     payment_id: str,
     background_tasks: BackgroundTasks,
@@ -125,25 +130,58 @@ async def lnurl_callback(
     if wallet.balance < fossa_payment.amount:
         return LnurlErrorResponse(reason="Not enough funds in wallet.")
 
+    # set to pending and pay invoice in background to prevent double spending,
+    # the claim is atomic so concurrent callbacks and workers cannot both pay
+    amount = int(fossa_payment.amount)
+    limit_reason = await withdraw_limits.reserve(fossa, amount)
+    if limit_reason:
+        return LnurlErrorResponse(reason=limit_reason)
+    if not await claim_fossa_payment(fossa_payment.id):
+        withdraw_limits.release(fossa.id, amount)
+        return LnurlErrorResponse(reason="Payment already claimed.")
+    fossa_payment.payment_hash = "pending"
+    limit_reason = await withdraw_limits.verify_claim(fossa, fossa_payment.id, amount)
+    if limit_reason:
+        return LnurlErrorResponse(reason=limit_reason)
+    payment_journal.record(
+        fossa_payment.id, fossa.id, PaymentEventType.CLAIMED, "lnurl"
+    )
     try:
-        # set to pending and pay invoice in background to prevent double spending
-        fossa_payment.payment_hash = "pending"
-        await update_fossa_payment(fossa_payment)
 
+        @trace_request("fossa.lnurl_pay_invoice")
         async def _pay_invoice():
-            payment = await pay_invoice(
-                wallet_id=fossa.wallet,
-                payment_request=pr,
-                max_sat=int(fossa_payment.amount),
-                extra={"tag": "fossa"},
-            )
+            try:
+                with span("pay_invoice"):
+                    payment = await pay_invoice(
+                        wallet_id=fossa.wallet,
+                        payment_request=pr,
+                        max_sat=int(fossa_payment.amount),
+                        extra={"tag": "fossa", "id": fossa_payment.id},
+                    )
+            except Exception as exc:
+                logger.warning(f"Fossa withdraw {fossa_payment.id} failed: {exc}")
+                # unsuccessful payment, release fossa_payment
+                fossa_payment.payment_hash = None
+                await update_fossa_payment(fossa_payment)
+                payment_journal.record(
+                    fossa_payment.id, fossa.id, PaymentEventType.FAILED, str(exc)
+                )
+                withdraw_limits.release(fossa.id, amount)
+                return
             fossa_payment.payment_hash = payment.payment_hash
             await update_fossa_payment(fossa_payment)
+            payment_journal.record(
+                fossa_payment.id, fossa.id, PaymentEventType.PAID, payment.payment_hash
+            )
 
         background_tasks.add_task(_pay_invoice)
         return LnurlSuccessResponse()
     except Exception as e:
         fossa_payment.payment_hash = None
         await update_fossa_payment(fossa_payment)
+        payment_journal.record(
+            fossa_payment.id, fossa.id, PaymentEventType.FAILED, str(e)
+        )
+        withdraw_limits.release(fossa.id, amount)
         logger.error(f"Payment processing failed: {e}")
         return LnurlErrorResponse(reason="Payment processing failed.")